@@ -37,6 +37,8 @@ class TransformerAgent(Agent):
                                 help='')
         agent_args.add_argument('--length_penalty', type=float, default=0.6,
                                 help='')
+        agent_args.add_argument('--quantize', type=bool, default=False,
+                                help='int8 dynamic quantization of the linear layers (cpu only)')
         
         return argparser
 
@@ -107,7 +109,9 @@ class TransformerAgent(Agent):
                                           sparse_embeddings=model_config.sparse_embeddings,
                                           shared_attention=model_config.sparse_embeddings,
                                           bs_temperature=model_config.bs_temperature,
-                                          bs_nucleus_p=model_config.bs_nucleus_p
+                                          bs_nucleus_p=model_config.bs_nucleus_p,
+                                          bs_fp16=model_config.bs_fp16,
+                                          bs_low_precision=model_config.bs_low_precision
                                           )
 
             state_dict = torch.load(model_config.checkpoint_path, map_location=lambda storage, loc: storage)
@@ -122,6 +126,9 @@ class TransformerAgent(Agent):
 
             self.model.eval()
 
+            if self.opt['quantize'] and not self.use_cuda:
+                self.model.quantize_for_inference()
+
             self.model = apex_model(self.model, apex_level=self.apex_level)
 
         else:
@@ -47,7 +47,11 @@ def get_model_config():
                        'use_start_end': env_config('USE_START_END', default=False, cast=bool),
                        'apex_level': env_config('APEX_LEVEL', default=None, cast=cast2(str)),  # 'O0', 'O1', 'O2', 'O3',
                        'bs_temperature': env_config('BS_TEMPERATURE', default=1, cast=float),
-                       'bs_nucleus_p': env_config('BS_NUCLEUS_P', default=0, cast=float)
+                       'bs_nucleus_p': env_config('BS_NUCLEUS_P', default=0, cast=float),
+                       'bs_fp16': env_config('BS_FP16', default=False, cast=bool),  # beam search decoder under fp16 autocast (gpu only)
+                       'bs_low_precision': env_config('BS_LOW_PRECISION', default=False, cast=bool),  # bf16 per step beam search probabilities, scores are accumulated in fp32
+                       'compile_embeddings': env_config('COMPILE_EMBEDDINGS', default=False, cast=bool),
+                       'gradient_checkpointing': env_config('GRADIENT_CHECKPOINTING', default=False, cast=bool)
                        })
 
     return config
@@ -68,7 +72,7 @@ def get_trainer_config():
                        'hits_weight': env_config('HITS_WEIGHT', default=0, cast=float),
                        'negative_samples': env_config('NEGATIVE_SAMPLES', default=0, cast=int),
                        'n_jobs': 4,
-                       'label_smoothing': env_config('LABEL_SMOOTHING', default=0.1, cast=float),
+                       'label_smoothing': env_config('LABEL_SMOOTHING', default=0.1, cast=float),  # CrossEntropyLoss smoothing: averaged over the target tokens, not over the vocabulary as before (see README)
                        'clip_grad': None,
                        'test_period': 1,
                        'seed': 0,
@@ -76,7 +80,8 @@ def get_trainer_config():
                        'zero_shot': env_config('ZERO_SHOT', default=False, cast=bool),
                        'persona_augment': env_config('PERSONA_AUGMENT', default=False, cast=bool),
                        'persona_aug_syn_proba': env_config('PERSONA_AUG_SYN_PROBA', default=0.0, cast=float),
-                       'apex_loss_scale': env_config('APEX_LOSS_SCALE', default=None, cast=cast2(str)), # e.g. '128', 'dynamic'
+                       'apex_loss_scale': env_config('APEX_LOSS_SCALE', default='128', cast=cast2(str)), # static by default, set 'dynamic' to enable dynamic scaling
+                       'fp16': env_config('FP16', default=False, cast=bool),  # native amp (autocast + GradScaler), exclusive with apex
                        'linear_schedule': env_config('LINEAR_SCHEDULE', default=True, cast=bool),
                        'evaluate_full_sequences': env_config('EVALUATE_FULL_SEQUENCES', default=True, cast=bool),
                        'limit_eval_size': env_config('LIMIT_EVAL_TIME', default=-1, cast=int),
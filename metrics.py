@@ -184,6 +184,13 @@ def nlp_metrics(path_refs, path_hyp, fld_out='temp',  n_lines=None):
     return nist, bleu, meteor, entropy, div, avg_len
 
 
+# metrics computed against references: calc(path_refs, path_hyp)
+_REF_METRICS = {'nist': calc_nist, 'bleu': calc_bleu, 'nist_bleu': calc_nist_bleu,
+                'cum_bleu': calc_cum_bleu, 'meteor': calc_meteor}
+# metrics computed on hypotheses only: calc(path_hyp)
+_HYP_METRICS = {'entropy': calc_entropy, 'div': calc_div, 'avg_len': calc_avg_len}
+
+
 def specified_nlp_metric(path_refs, path_hyp, metric):
     i = None
 
@@ -191,10 +198,12 @@ def specified_nlp_metric(path_refs, path_hyp, metric):
     if m:
         metric, i = metric[:m.span()[0]], int(metric[m.span()[0]+1:]) - 1
 
-    try:
-        res = eval(f'calc_{metric}(path_refs, path_hyp)')
-    except:
-        res = eval(f'calc_{metric}(path_hyp)')
+    if metric in _REF_METRICS:
+        res = _REF_METRICS[metric](path_refs, path_hyp)
+    elif metric in _HYP_METRICS:
+        res = _HYP_METRICS[metric](path_hyp)
+    else:
+        raise ValueError('Unknown metric: {}'.format(metric))
 
     return res if i is None else res[i]
 
@@ -63,14 +63,14 @@ class FacebookDataset(Dataset):
     def make_dataset(data, vocab):
         dataset = []
         for chat in tqdm(data):
-            persona_info = [vocab.string2ids(s) for s in chat['persona_info']]
+            persona_info = vocab.strings2ids(chat['persona_info'])
 
             dialog = []
             for i, replica in enumerate(chat['dialog'], 1):
                 dialog.append(vocab.string2ids(replica))
                 if not i % 2:
                     if chat['candidates']:
-                        candidates_ids = [vocab.string2ids(c) for c in chat['candidates'][(i-1)//2]]
+                        candidates_ids = vocab.strings2ids(chat['candidates'][(i-1)//2])
                         dataset.append((persona_info, dialog[:], candidates_ids))
                     else:
                         dataset.append((persona_info, dialog[:], []))
@@ -96,15 +96,39 @@ class FacebookDataset(Dataset):
         self.use_start_end = use_start_end
         self.negative_samples = negative_samples  # -1 => include all candidates in data instance
 
+        # the cache file holds the tokenized data and, without augmentation, the sample tensors built from it:
+        # they depend on the sample parameters and are only reused when built with the same ones
+        samples_key = (max_lengths, dialog_embeddings, use_start_end)
+        cached_samples, save_cache = {}, False
         if cache and os.path.exists(cache):
-            self.data = torch.load(cache)
+            cached = torch.load(cache)
+            if isinstance(cached, dict):
+                data, cached_samples = cached['data'], cached['samples']
+            else:  # cache files with the tokenized data only
+                data = cached
         else:
             parsed_data = sum([FacebookDataset.parse_data(path) for path in paths], [])
-            self.data = FacebookDataset.make_dataset(parsed_data, vocab)
-            if cache:
-                torch.save(self.data, cache)
-        if limit_size > 0:
-            self.data = self.data[:limit_size]
+            data = FacebookDataset.make_dataset(parsed_data, vocab)
+            save_cache = bool(cache)
+        self.data = data[:limit_size] if limit_size > 0 else data
+
+        # without augmentation the context and target tensors are built only once per sample: here, before the loader
+        # workers fork (so they share them) and outside of any inference mode (so they can be used with autograd)
+        self._samples_cache = None
+        if not self.augment:
+            samples = cached_samples.get(samples_key)
+            if samples is None or len(samples) < len(self.data):
+                with torch.inference_mode(False):
+                    samples = [self._make_sample(persona_info, dialog) for persona_info, dialog, _ in tqdm(self.data)]
+                if cache and len(self.data) == len(data):
+                    cached_samples[samples_key] = samples
+                    save_cache = True
+            self._samples_cache = samples[:len(self.data)]
+            # the token lists are not needed anymore, only the last replies may be sampled as distractors
+            self.data = [(None, dialog[-1:], candidates) for _, dialog, candidates in self.data]
+
+        if save_cache:
+            torch.save({'data': data, 'samples': cached_samples}, cache)
 
     def __len__(self):
         return len(self.data)
@@ -149,9 +173,13 @@ class FacebookDataset(Dataset):
             distractors = [self.data[ids][1][-1] for ids in distractors]
         return distractors
 
-    def __getitem__(self, idx):
-        persona_info, dialog, candidates = self.data[idx]
+    def _sentence2tensor(self, y):
+        y = [self.vocab.bos_id] + y[:self.max_lengths-2] + [self.vocab.eos_id]
+        if self.dialog_embeddings:
+            y = [[tok, self.vocab.sent_dialog_id] for tok in y]
+        return torch.tensor(y, dtype=torch.long)
 
+    def _make_sample(self, persona_info, dialog):
         if len(persona_info):
             persona_info = self._augment(persona_info, info=True)
             persona_info = sum(persona_info, [])
@@ -160,7 +188,6 @@ class FacebookDataset(Dataset):
                 persona_info = [[tok, self.vocab.info_dialog_id] for tok in persona_info]
 
         dialog = self._augment(dialog)
-        candidates = self._get_distractors(candidates)
 
         h = []
         for i, ids in enumerate(dialog[:-1], 1):
@@ -173,11 +200,18 @@ class FacebookDataset(Dataset):
             h.extend(ids)
         h = h[-self.max_lengths:]
 
-        sentences = []
-        for y in (dialog[-1:] + candidates):
-            y = [self.vocab.bos_id] + y[:self.max_lengths-2] + [self.vocab.eos_id]
-            if self.dialog_embeddings:
-                y = [[tok, self.vocab.sent_dialog_id] for tok in y]
-            sentences.append(y)
+        # tensors are built here, in the loader workers, so that the collate function only has to pad them
+        return torch.tensor(persona_info, dtype=torch.long), torch.tensor(h, dtype=torch.long), \
+               self._sentence2tensor(dialog[-1])
+
+    def __getitem__(self, idx):
+        persona_info, dialog, candidates = self.data[idx]
+
+        if self._samples_cache is None:
+            persona_info, h, y = self._make_sample(persona_info, dialog)
+        else:
+            persona_info, h, y = self._samples_cache[idx]
+
+        distractors = [self._sentence2tensor(d) for d in self._get_distractors(candidates)]
 
-        return persona_info, h, sentences[0], sentences[1:]
+        return persona_info, h, y, distractors
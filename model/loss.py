@@ -1,53 +0,0 @@
-#  transformer_chatbot
-#  Copyright (C) 2018 Golovanov, Tselousov
-#
-#  This program is free software: you can redistribute it and/or modify
-#  it under the terms of the GNU Affero General Public License as published by
-#  the Free Software Foundation, either version 3 of the License, or
-#  (at your option) any later version.
-#
-#  This program is distributed in the hope that it will be useful,
-#  but WITHOUT ANY WARRANTY; without even the implied warranty of
-#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-#  GNU Affero General Public License for more details.
-#
-#  You should have received a copy of the GNU Affero General Public License
-#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
-import torch
-import torch.nn as nn
-
-
-class LabelSmoothingLoss(nn.Module):
-    def __init__(self, n_labels, smoothing=0.0, ignore_index=-100, size_average=True):
-        super(LabelSmoothingLoss, self).__init__()
-        assert 0 <= smoothing <= 1
-
-        self.ignore_index = ignore_index
-        self.confidence = 1 - smoothing
-
-        if smoothing > 0:
-            self.criterion = nn.KLDivLoss(size_average=size_average)
-            n_ignore_idxs = 1 + (ignore_index >= 0)
-            one_hot = torch.full((1, n_labels), fill_value=(smoothing / (n_labels - n_ignore_idxs)))
-            if ignore_index >= 0:
-                one_hot[0, ignore_index] = 0
-            self.register_buffer('one_hot', one_hot)
-        else:
-            self.criterion = nn.NLLLoss(size_average=size_average, ignore_index=ignore_index)
-        
-    def forward(self, log_inputs, targets):
-        if self.confidence < 1:
-            tdata = targets.data
-  
-            tmp = self.one_hot.repeat(targets.shape[0], 1)
-            tmp.scatter_(1, tdata.unsqueeze(1), self.confidence)
-
-            if self.ignore_index >= 0:
-                mask = torch.nonzero(tdata.eq(self.ignore_index)).squeeze(-1)
-                if mask.numel() > 0:
-                    tmp.index_fill_(0, mask, 0)
-
-            targets = tmp
-        
-        return self.criterion(log_inputs, targets)
@@ -148,12 +148,14 @@ class Adam(torch.optim.Optimizer):
 
 
 class NoamOpt:
-    def __init__(self, embeddings_size, warmup, optimizer, linear_schedule=False, lr=None, total_steps=None, apex_level=None):
+    def __init__(self, embeddings_size, warmup, optimizer, linear_schedule=False, lr=None, total_steps=None, apex_level=None,
+                 fp16=False):
         self.embeddings_size = embeddings_size
         self.warmup = warmup
         self.optimizer = optimizer
         self.linear_schedule = linear_schedule
         self.apex_level = apex_level
+        self.scaler = torch.cuda.amp.GradScaler(enabled=fp16)  # native amp, a no-op when disabled
         self.lr = lr
         self.total_steps = total_steps
 
@@ -161,10 +163,13 @@ class NoamOpt:
         
     def state_dict(self):
         return {'step': self._step,
-                'optimizer': self.optimizer.state_dict()}
+                'optimizer': self.optimizer.state_dict(),
+                'scaler': self.scaler.state_dict()}
 
     def load_state_dict(self, state_dict):
         self._step = state_dict['step']
+        if self.scaler.is_enabled() and state_dict.get('scaler'):
+            self.scaler.load_state_dict(state_dict['scaler'])
         try:
             self.optimizer.load_state_dict(state_dict['optimizer'])
         except ValueError as e:
@@ -187,11 +192,18 @@ class NoamOpt:
                 with scale_loss(loss, self.optimizer, loss_id=loss_id) as scaled_loss:
                     scaled_loss.backward()
         else:
-            full_loss.backward()
+            self.scaler.scale(full_loss).backward()
         return full_loss
 
-    def zero_grad(self):
-        return self.optimizer.zero_grad()
+    def unscale_(self):
+        " Unscales gradients inplace (e.g. before clipping), only needed with native amp "
+        if self.scaler.is_enabled():
+            self.scaler.unscale_(self.optimizer)
+
+    def zero_grad(self, set_to_none=True):
+        if self.apex_level is not None:
+            return self.optimizer.zero_grad()  # apex patches zero_grad without arguments
+        return self.optimizer.zero_grad(set_to_none=set_to_none)
 
     def get_lr(self):
         return self.optimizer.param_groups[0]['lr']
@@ -201,11 +213,15 @@ class NoamOpt:
         return self.optimizer.param_groups
 
     def step(self):
-        self._step += 1
-        rate = self.rate_linear() if self.linear_schedule else self.rate()
+        rate = self.rate_linear(self._step + 1) if self.linear_schedule else self.rate(self._step + 1)
         for p in self.optimizer.param_groups:
             p['lr'] = rate
-        self.optimizer.step()
+        scale = self.scaler.get_scale()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        # the scaler skips the optimizer step (and lowers the scale) on inf/nan gradients: the schedule doesn't advance
+        if self.scaler.get_scale() >= scale:
+            self._step += 1
         
     def rate(self, step=None):
         if step is None:
@@ -14,23 +14,32 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 from collections import Counter, defaultdict
 
 import ftfy
+import numpy as np
 import spacy
 from tqdm import trange
 
 
 class SpacyLowerTokenizer:
     def __init__(self):
-        self.tokenizer = spacy.load('en', disable=['parser', 'tagger', 'ner', 'textcat'])
+        self.tokenizer = spacy.blank('en')  # only the tokenizer is used: no need to load the statistical model
+
+    @staticmethod
+    def _doc2words(doc):
+        return [t.lower_ for t in doc if not t.is_space]
 
     def __call__(self, string):
         string = ftfy.fix_text(string)
-        words = [t.text.strip() for t in self.tokenizer(string)]
-        words = [w.lower() for w in words if w]
 
-        return words
+        return self._doc2words(self.tokenizer(string))
+
+    def pipe(self, strings, batch_size=256):
+        strings = (ftfy.fix_text(s) for s in strings)
+        for doc in self.tokenizer.pipe(strings, batch_size=batch_size):
+            yield self._doc2words(doc)
 
 class BPEVocab:
     we = '</w>'
@@ -71,7 +80,7 @@ class BPEVocab:
 
         return set(zip(string[:-1], string[1:]))
 
-    def __init__(self, vocab, codes, tokenizer=SpacyLowerTokenizer(), zero_shot=False):
+    def __init__(self, vocab, codes, tokenizer=SpacyLowerTokenizer(), zero_shot=False, cache_size=200000):
         if zero_shot: # only one additional token: BPEVocab.pad_token = <pad>
             self.spec_tokens = [BPEVocab.pad_token]
             self.bos_token = '"</w>'
@@ -95,10 +104,27 @@ class BPEVocab:
         vocab = self.spec_tokens + vocab
 
         self.token2id = {t: i for i, t in enumerate(vocab)}
-        self.id2token = {i: t for i, t in enumerate(vocab)}
+        self.id2token = list(vocab)  # ids are the contiguous range 0..len(vocab)-1
+        # tokens as they appear in decoded strings: end-of-word marker already replaced by a space
+        self._id2rendered = [t[:-len(BPEVocab.we)] + ' ' if t.endswith(BPEVocab.we) else t for t in vocab]
         self.bpe_ranks = dict(zip(codes, range(len(codes))))
         self.tokenizer = tokenizer
-        self.cache = {}
+        self.cache_size = cache_size
+        self._init_bpe_cache()
+
+    def _init_bpe_cache(self):
+        # bounded memoization of tokens, the cache only references the merge ranks (not the vocab itself)
+        self._bpe = functools.lru_cache(maxsize=self.cache_size)(functools.partial(BPEVocab._bpe_merge, self.bpe_ranks))
+
+    def __getstate__(self):
+        # the lru_cache wrapper can't be pickled (spawned loader workers, deepcopy): it is rebuilt empty
+        state = self.__dict__.copy()
+        del state['_bpe']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_bpe_cache()
 
     def __len__(self):
         return len(self.token2id)
@@ -166,11 +192,10 @@ class BPEVocab:
     def get_prefix2words(self, convai_dict, smoothing_freq=5):
         # map BPE-prefix => dict(full_words beginning with BPE-prefix, associated words_counts)
         prefix2words = defaultdict(dict)
-        for i in trange(len(convai_dict)):
+        for i in trange(len(convai_dict), mininterval=1.0):
             word = convai_dict[i]
-            freq = convai_dict.freq[word] + smoothing_freq
             prefix = self._bpe(word)[0]
-            prefix2words[prefix].update(dict([(word, freq)]))
+            prefix2words[prefix][word] = convai_dict.freq[word] + smoothing_freq
 
         # translate in map of frequency ratios
         for prefix, words in prefix2words.items():
@@ -179,10 +204,8 @@ class BPEVocab:
 
         return prefix2words
 
-    def _bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-
+    @staticmethod
+    def _bpe_merge(bpe_ranks, token):
         word = tuple(token[:-1]) + (token[-1] + BPEVocab.we,)
         pairs = BPEVocab.get_pairs(word)
 
@@ -190,24 +213,19 @@ class BPEVocab:
             return (token + BPEVocab.we,)
 
         while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
+            bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float('inf')))
+            if bigram not in bpe_ranks:
                 break
 
+            # merge all the occurrences of the bigram in a single left-to-right pass
             first, second = bigram
+            merged = first + second
+            last = len(word) - 1
             new_word = []
             i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first + second)
+            while i <= last:
+                if i < last and word[i] == first and word[i+1] == second:
+                    new_word.append(merged)
                     i += 2
                 else:
                     new_word.append(word[i])
@@ -220,16 +238,33 @@ class BPEVocab:
             else:
                 pairs = BPEVocab.get_pairs(word)
 
-        self.cache[token] = word
-
         return word
 
+    def _tokens2ids(self, tokens):
+        token2id = self.token2id.get
+        ids = [token2id(bpe_t) for t in tokens for bpe_t in self._bpe(t)]
+
+        return [i for i in ids if i is not None]  # BPE symbols out of the vocabulary are dropped
+
     def string2ids(self, string):
-        tokens = self.tokenizer(string)
-        bpe_tokens = sum([self._bpe(t) for t in tokens], tuple())
-        ids = [self.token2id[t] for t in bpe_tokens if t in self.token2id]
+        return self._tokens2ids(self.tokenizer(string))
+
+    def strings2ids(self, strings):
+        " Same as string2ids for a list of strings, tokenized in batches when the tokenizer supports it "
+        tokens = self.tokenizer.pipe(strings) if hasattr(self.tokenizer, 'pipe') else map(self.tokenizer, strings)
+        return [self._tokens2ids(t) for t in tokens]
+
+    def strings2ids_batch(self, strings, pad_id=None):
+        " Returns a (len(strings), max_len) int32 array of ids right-padded with pad_id (default: vocab padding) "
+        if pad_id is None:
+            pad_id = self.pad_id
+
+        ids = self.strings2ids(strings)
+        batch = np.full((len(ids), max(map(len, ids), default=0)), pad_id, dtype=np.int32)
+        for i, seq in enumerate(ids):
+            batch[i, :len(seq)] = seq
 
-        return ids
+        return batch
 
     @staticmethod
     def to_ids_list(list_obj):
@@ -245,6 +280,5 @@ class BPEVocab:
 
     def ids2string(self, ids):
         ids = self.to_ids_list(ids)
-        bpe_tokens = [self.id2token[id] for id in ids]
 
-        return ''.join(bpe_tokens).replace(BPEVocab.we, ' ')
+        return ''.join([self._id2rendered[id] for id in ids])
@@ -17,6 +17,7 @@
 import logging
 import math
 import random
+from contextlib import nullcontext
 
 import numpy as np
 import torch
@@ -26,9 +27,8 @@ from torch.utils.data import DataLoader, DistributedSampler, RandomSampler
 from tensorboardX import SummaryWriter
 from tqdm import tqdm
 
-from .loss import LabelSmoothingLoss
 from .optim import Adam, NoamOpt
-from .utils import pad_sequence, repeat_along_dim1
+from .utils import CUDAPrefetcher, pad_sequence
 from .transformer_model import apex_model
 
 
@@ -39,17 +39,18 @@ class Trainer:
     def __init__(self, model, train_dataset, writer=SummaryWriter(), test_dataset=None, train_batch_size=8, test_batch_size=8,
                  batch_split=1, s2s_weight=1, lm_weight=0.5, risk_weight=0, hits_weight=0, lr=6.25e-5, lr_warmup=2000,
                  n_jobs=0, clip_grad=None, label_smoothing=0, device=torch.device('cuda'), weight_decay=0.1,
-                 ignore_idxs=[], local_rank=-1, apex_level=None, apex_loss_scale=None,
+                 ignore_idxs=[], local_rank=-1, apex_level=None, apex_loss_scale=None, fp16=False,
                  linear_schedule=False, n_epochs=0, single_input=False, evaluate_full_sequences=False):
         n_gpu = torch.cuda.device_count()
-        logger.info("device: {}, distributed training: {}, apex_level: {}, apex_scale_loss: {},  n_gpu: {}".format(
-            device, bool(local_rank != -1), apex_level, apex_loss_scale, n_gpu))
+        fp16 = fp16 and torch.device(device).type == 'cuda'
+        logger.info("device: {}, distributed training: {}, apex_level: {}, apex_scale_loss: {}, fp16: {}, n_gpu: {}".format(
+            device, bool(local_rank != -1), apex_level, apex_loss_scale, fp16, n_gpu))
 
         self.model = model.to(device)
 
         self.lm_criterion = nn.CrossEntropyLoss(ignore_index=self.model.padding_idx).to(device)
         self.hits_criterion = nn.CrossEntropyLoss().to(device)
-        self.criterion = LabelSmoothingLoss(n_labels=self.model.n_embeddings, smoothing=label_smoothing, ignore_index=self.model.padding_idx).to(device)
+        self.criterion = nn.CrossEntropyLoss(ignore_index=self.model.padding_idx, label_smoothing=label_smoothing).to(device)
 
         param_optimizer = list(self.model.named_parameters())  # Here we should remove parameters which are not used during to avoid breaking apex with None grads
         no_decay = ['bias']
@@ -60,29 +61,35 @@ class Trainer:
 
         base_optimizer = Adam(optimizer_grouped_parameters, lr=lr)
         assert local_rank == -1 or apex_level is None, 'Distributed model with apex optimization is not supported right now.'
+        assert not fp16 or apex_level is None, 'Native amp (fp16) and apex optimization can\'t be used together.'
         self.model, base_optimizer = apex_model(self.model, optimizer=base_optimizer,
                                                 apex_level=apex_level, apex_loss_scale=apex_loss_scale)
 
         if not linear_schedule:
             self.optimizer = NoamOpt(self.model.embeddings_size, lr_warmup, base_optimizer, lr=lr,
-                                     linear_schedule=False, apex_level=apex_level)
+                                     linear_schedule=False, apex_level=apex_level, fp16=fp16)
         else:
             total_steps = len(train_dataset) * n_epochs // train_batch_size
             if local_rank != -1:
                 total_steps = total_steps // torch.distributed.get_world_size()
             self.optimizer = NoamOpt(self.model.embeddings_size, lr_warmup, base_optimizer, linear_schedule=True,
-                                     lr=lr, total_steps=total_steps, apex_level=apex_level)
+                                     lr=lr, total_steps=total_steps, apex_level=apex_level, fp16=fp16)
 
         if local_rank == -1:
             train_sampler = RandomSampler(train_dataset)
         else:
             train_sampler = DistributedSampler(train_dataset)
+        # pinned batches can be copied asynchronously to the gpu, workers are kept alive between epochs
+        loader_kwargs = {'num_workers': n_jobs, 'collate_fn': self.collate_func,
+                         'pin_memory': torch.device(device).type == 'cuda'}
+        if n_jobs > 0:
+            loader_kwargs.update(prefetch_factor=4, persistent_workers=True)
         self.train_dataloader = DataLoader(train_dataset, batch_size=train_batch_size//batch_split, sampler=train_sampler, 
-                                           num_workers=n_jobs, collate_fn=self.collate_func)
+                                           **loader_kwargs)
         self.train_dataset = train_dataset  # used to sample negative examples
         if test_dataset is not None and local_rank in [-1, 0]:  # only do evaluation on main process
             self.test_dataloader = DataLoader(test_dataset, batch_size=test_batch_size, shuffle=False, 
-                                              num_workers=n_jobs, collate_fn=self.collate_func)
+                                              **loader_kwargs)
         self.vocab = train_dataset.vocab
         self.writer = writer
 
@@ -94,7 +101,10 @@ class Trainer:
         self.clip_grad = clip_grad
         self.device = device
         self.ignore_idxs = ignore_idxs
+        self._ignore_ids = torch.tensor(ignore_idxs, dtype=torch.long, device=device)
+        self._clf_labels = torch.zeros(max(train_batch_size // batch_split, test_batch_size), dtype=torch.long, device=device)
         self.apex_level = apex_level
+        self.fp16 = fp16
         self.n_epochs = n_epochs
         self.single_input = single_input
         self.evaluate_full_sequences = evaluate_full_sequences
@@ -117,23 +127,21 @@ class Trainer:
         contexts = []
 
         if max(map(len, persona_info)) > 0:
-            persona_info = [torch.tensor(d, dtype=torch.long) for d in persona_info]
             contexts.append(persona_info)
 
         if max(map(len, h)) > 0:
-            h = [torch.tensor(d, dtype=torch.long) for d in h]
             contexts.append(h)
 
-        y_out = [torch.tensor(d, dtype=torch.long) for d in y]
+        y_out = list(y)
 
-        distractors = [torch.tensor(d, dtype=torch.long) for distractors in distractors_batch for d in distractors]
+        distractors = [d for distractors in distractors_batch for d in distractors]
 
-        if self.single_input:
+        if self.single_input and contexts:
             # we concatenate all the contexts in y (idem for distractors)
-            y_out = [torch.cat(pieces, dim=0) for pieces in zip(*(contexts + [y_out]))]
-            extended_contexts = [[t for t in c for _ in range(len(distractors)//len(y))] for c in contexts]
-            distractors = [torch.cat(pieces, dim=0) for pieces in zip(*(extended_contexts + [distractors]))]
             contexts = [torch.cat(pieces, dim=0) for pieces in zip(*contexts)]
+            n_distractors = len(distractors) // len(y)
+            y_out = [torch.cat((c, t), dim=0) for c, t in zip(contexts, y_out)]
+            distractors = [torch.cat((contexts[i // n_distractors], d), dim=0) for i, d in enumerate(distractors)]
 
         # Pad now so we pad correctly when we have only a single input (context concatenated with y)
         y_out = pad_sequence(y_out, batch_first=True, padding_value=self.model.padding_idx)
@@ -149,50 +157,59 @@ class Trainer:
         if self.single_input:
             return batch_lm_loss
 
-        for context in contexts:
-            enc_context = self.model.encode(context.clone())
-            enc_contexts.append(enc_context)
+        enc_contexts.extend(self.model.encode_contexts(contexts))
 
+        for context, enc_context in zip(contexts, enc_contexts):
             if self.lm_weight > 0:
                 context_outputs = self.model.generate(enc_context[0])
-                ignore_mask = torch.stack([context == idx for idx in self.ignore_idxs], dim=-1).any(dim=-1)
-                context.masked_fill_(ignore_mask, self.model.padding_idx)
+                ignore_mask = torch.isin(context, self._ignore_ids)
+                nexts = context.masked_fill(ignore_mask, self.model.padding_idx)  # the batch tensor itself is left untouched
                 prevs = context_outputs[:, :-1, :].contiguous()
-                nexts = context[:, 1:].contiguous() if context.dim() == 2 else context[:, 1:, 0].contiguous()
-                batch_lm_loss += self.lm_criterion(prevs.view(-1, prevs.shape[-1]).float(), nexts.view(-1)) / len(contexts)
+                nexts = nexts[:, 1:].contiguous() if nexts.dim() == 2 else nexts[:, 1:, 0].contiguous()
+                batch_lm_loss += self.lm_criterion(self._loss_logits(prevs.view(-1, prevs.shape[-1])), nexts.view(-1)) / len(contexts)
         return batch_lm_loss
 
+    def _loss_logits(self, logits):
+        " Logits fed to the losses: autocast keeps the losses in fp32, otherwise (apex O2/O3 half models) they are upcast "
+        return logits if self.fp16 else logits.float()
+
+    def _use_hits(self, negative_samples):
+        return self.hits_weight > 0 and negative_samples > 0 and self.model.multiple_choice_head is not None
+
     def _s2s_loss(self, targets, enc_contexts, negative_samples):
         hidden_state, padding_mask = None, None
 
         nexts = targets[:, 1:].contiguous() if targets.dim() == 2 else targets[:, 1:, 0].contiguous()
-        if self.hits_weight > 0 and negative_samples > 0:
+        if self._use_hits(negative_samples):
             # Keep the hidden states for hits@1 loss
             hidden_state, padding_mask, _ = self.model.transformer_module(targets, enc_contexts)
             outputs = self.model.generate(hidden_state[:, :-1].contiguous())
         else:
             outputs = self.model.decode(targets[:, :-1].contiguous(), enc_contexts)
 
-        outputs = outputs.view(-1, outputs.shape[-1]).float()
+        outputs = self._loss_logits(outputs.view(-1, outputs.shape[-1]))
         nexts = nexts.view(-1)
 
-        loss = self.criterion(F.log_softmax(outputs, dim=-1), nexts) if self.model.training \
+        loss = self.criterion(outputs, nexts) if self.model.training \
                else self.lm_criterion(outputs, nexts)
         return loss, hidden_state, padding_mask
 
     def _hist(self, distractors, hidden_state, padding_mask, enc_contexts, negative_samples):
         batch_hits_loss = torch.tensor(0, dtype=torch.float, device=self.device)
 
-        if self.hits_weight == 0 or negative_samples == 0 or self.model.multiple_choice_head is None:
+        if not self._use_hits(negative_samples):
             return batch_hits_loss
 
-        extended_contexts = repeat_along_dim1(enc_contexts, negative_samples)
-        neg_logits = self.model.decode_classify(distractors, extended_contexts)
+        # the distractors of an item are consecutive rows, the attention broadcasts its contexts over them
+        neg_logits = self.model.decode_classify(distractors, enc_contexts)
         true_logits = self.model.classify(hidden_state, padding_mask)
         clf_logits = torch.cat((true_logits.view(-1, 1), neg_logits.view(-1, negative_samples)), dim=1)
-        clf_labels = torch.tensor([0] * len(true_logits), dtype=torch.long, device=self.device)
+        if len(true_logits) > len(self._clf_labels):
+            with torch.inference_mode(False):  # may be grown during evaluation and reused in training
+                self._clf_labels = torch.zeros(len(true_logits), dtype=torch.long, device=self.device)
+        clf_labels = self._clf_labels[:len(true_logits)]  # the target is always the first candidate
 
-        batch_hits_loss = self.hits_criterion(clf_logits.float(), clf_labels) if self.model.training else \
+        batch_hits_loss = self.hits_criterion(self._loss_logits(clf_logits), clf_labels) if self.model.training else \
                           torch.sum(torch.max(clf_logits, dim=1)[1] == clf_labels).float() / clf_labels.shape[0]
 
         return batch_hits_loss
@@ -211,18 +228,19 @@ class Trainer:
             beams, beam_lens = self.model.beam_search(enc_contexts=enc_contexts, return_beams=True)
 
         self.model.train()  # re-activate dropout
+        beams, beam_lens = beams.clone(), beam_lens.clone()  # inference tensors can't be used in the autograd graph
 
         labels = targets if targets.dim() == 2 else targets[:, :, 0]
         labels_lens = labels.ne(self.model.padding_idx).sum(dim=-1)
         labels_start = [context.shape[0] + 1 for context in contexts] if self.single_input else [1] * len(labels)
         labels = [t[s:l - 1].tolist() for t, s, l in zip(labels, labels_start, labels_lens)]
 
+        beams_list, beam_lens_list = beams.tolist(), beam_lens.tolist()
         batch_risks = []
         for b in range(self.model.beam_size):
-            predictions = [t[b][1:l[b] - 1].tolist() for t, l in zip(beams, beam_lens)]
-            risks = torch.tensor(risk_func(predictions, labels), dtype=torch.float, device=self.device)
-            batch_risks.append(risks)
-        batch_risks = torch.stack(batch_risks, dim=-1)
+            predictions = [t[b][1:l[b] - 1] for t, l in zip(beams_list, beam_lens_list)]
+            batch_risks.append(risk_func(predictions, labels))
+        batch_risks = torch.tensor(batch_risks, dtype=torch.float, device=self.device).t()
 
         if self.model.dialog_embeddings:
             beams = torch.stack((beams, torch.full_like(beams, self.model.sent_dialog_id)), dim=beams.dim())
@@ -233,79 +251,75 @@ class Trainer:
             beam_starts = beam_starts.repeat([1, self.model.beam_size] + [1] * len(beam_starts.size()[2:])) # tail_dims for dialog_embeddings
             beams = torch.cat((beam_starts, beams), dim=2)
 
-        batch_probas = []
-        for b in range(self.model.beam_size):
-            inputs = beams[:, b, :-1]
-            outputs = beams[:, b, 1:]
-
-            outputs = outputs[:, :, 0] if outputs.dim() == 3 else outputs
-            logits = self.model.decode(inputs, enc_contexts)
-
-            probas = F.log_softmax(logits.float(), dim=-1)
-            probas = torch.gather(probas, -1, outputs.unsqueeze(-1)).squeeze(-1)
-            probas.masked_fill_(outputs.eq(self.model.padding_idx), 0)
-            probas = probas[:, start:] if self.single_input else probas
+        # all the beams are decoded in a single pass: (batch, beam, ...) -> (batch * beam, ...)
+        batch_size, beam_size = beams.shape[:2]
+        inputs = beams[:, :, :-1].reshape(batch_size * beam_size, -1, *beams.shape[3:])
+        outputs = beams[:, :, 1:]
+        outputs = outputs[:, :, :, 0] if outputs.dim() == 4 else outputs
 
-            probas = probas.sum(dim=-1) / beam_lens[:, b].float()
+        logits = self.model.decode(inputs, enc_contexts)  # contexts are broadcast over the beams of each item
 
-            batch_probas.append(probas)
-        batch_probas = torch.stack(batch_probas, dim=-1)
-        batch_probas = F.softmax(batch_probas, dim=-1)
+        probas = F.log_softmax(self._loss_logits(logits), dim=-1).view(batch_size, beam_size, -1, logits.shape[-1])
+        probas = torch.gather(probas, -1, outputs.unsqueeze(-1)).squeeze(-1)
+        probas.masked_fill_(outputs.eq(self.model.padding_idx), 0)
+        probas = probas[:, :, start:] if self.single_input else probas
 
-        batch_risk_loss = torch.mean((batch_risks * batch_probas).sum(dim=-1))
+        batch_probas = probas.sum(dim=-1) / beam_lens.float()
+        batch_risk_loss = (batch_risks * F.softmax(batch_probas, dim=-1)).sum(dim=-1).mean()
 
         return batch_risk_loss
 
     def _eval_train(self, epoch, risk_func=None): # add ppl and hits@1 evaluations
         self.model.train()
 
-        tqdm_data = tqdm(self.train_dataloader, desc='Train (epoch #{})'.format(epoch))
-        s2s_loss = 0
-        lm_loss = 0
-        risk_loss = 0
-        hits_loss = 0
+        tqdm_data = tqdm(CUDAPrefetcher(self.train_dataloader, self.device), desc='Train (epoch #{})'.format(epoch))
+        # lm, s2s, risk and hits losses are summed on the device and only read back at optimization steps
+        losses_sum = torch.zeros(4, dtype=torch.float, device=self.device)
         for i, (contexts, targets, distractors) in enumerate(tqdm_data):
-            contexts, targets, distractors = [c.to(self.device) for c in contexts], targets.to(self.device), distractors.to(self.device)
+            # gradients of distributed modules are only all-reduced on the last micro-batch of an accumulation
+            sync_context = nullcontext() if (i + 1) % self.batch_split == 0 else self.model.no_sync()
+            with sync_context:
+                # autocast keeps log_softmax/cross entropy in fp32 without explicit upcasts (see _loss_logits)
+                with torch.cuda.amp.autocast(enabled=self.fp16):
+                    negative_samples = len(distractors)//len(targets)
+                    enc_contexts = []
 
-            negative_samples = len(distractors)//len(targets)
-            enc_contexts = []
+                    # lm loss on contexts
+                    batch_lm_loss = self._lm_loss(contexts, enc_contexts)
 
-            # lm loss on contexts
-            batch_lm_loss = self._lm_loss(contexts, enc_contexts)
+                    # s2s loss on targets
+                    batch_s2s_loss, hidden_state, padding_mask = self._s2s_loss(targets, enc_contexts, negative_samples)
 
-            # s2s loss on targets
-            batch_s2s_loss, hidden_state, padding_mask = self._s2s_loss(targets, enc_contexts, negative_samples)
+                    # hits@1 loss on distractors and targets
+                    batch_hits_loss = self._hist(distractors, hidden_state, padding_mask, enc_contexts, negative_samples)
 
-            # hits@1 loss on distractors and targets
-            batch_hits_loss = self._hist(distractors, hidden_state, padding_mask, enc_contexts, negative_samples)
+                    # risk loss
+                    batch_risk_loss = self._risk_loss(contexts, targets, enc_contexts, risk_func)
 
-            # risk loss
-            batch_risk_loss = self._risk_loss(contexts, targets, enc_contexts, risk_func)
+                    # optimization
+                    full_loss = (self.lm_weight * batch_lm_loss / self.batch_split,
+                                 self.risk_weight * batch_risk_loss / self.batch_split,
+                                 self.hits_weight * batch_hits_loss / self.batch_split,
+                                 self.s2s_weight * batch_s2s_loss / self.batch_split)
+                    full_loss = tuple(filter(lambda x: x.requires_grad, full_loss))
 
-            # optimization
-            full_loss = (self.lm_weight * batch_lm_loss / self.batch_split,
-                         self.risk_weight * batch_risk_loss / self.batch_split,
-                         self.hits_weight * batch_hits_loss / self.batch_split,
-                         self.s2s_weight * batch_s2s_loss / self.batch_split)
-            full_loss = tuple(filter(lambda x: x.requires_grad, full_loss))
+                full_loss = self.optimizer.backward(full_loss)
 
-            full_loss = self.optimizer.backward(full_loss)
-
-            lm_loss = (i * lm_loss + batch_lm_loss.item()) / (i + 1)
-            s2s_loss = (i * s2s_loss + batch_s2s_loss.item()) / (i + 1)
-            risk_loss = (i * risk_loss + batch_risk_loss.item()) / (i + 1)
-            hits_loss = (i * hits_loss + batch_hits_loss.item()) / (i + 1)
-            tqdm_data.set_postfix({'lm_loss': lm_loss, 's2s_loss': s2s_loss,
-                                   'risk_loss': risk_loss, 'hits_loss': hits_loss})
+            losses_sum += torch.stack((batch_lm_loss, batch_s2s_loss, batch_risk_loss, batch_hits_loss)).detach()
 
             if (i + 1) % self.batch_split == 0:
                 if self.clip_grad is not None:
+                    self.optimizer.unscale_()
                     for group in self.optimizer.param_groups:
                         nn.utils.clip_grad_norm_(group['params'], self.clip_grad)
 
                 self.optimizer.step()
                 self.optimizer.zero_grad()
 
+                lm_loss, s2s_loss, risk_loss, hits_loss = (losses_sum / (i + 1)).tolist()
+                tqdm_data.set_postfix({'lm_loss': lm_loss, 's2s_loss': s2s_loss,
+                                       'risk_loss': risk_loss, 'hits_loss': hits_loss})
+
                 global_step = max(self.global_step, 0)
                 self.writer.add_scalar("training/lm_loss", lm_loss, global_step=global_step)
                 self.writer.add_scalar("training/risk_loss", risk_loss, global_step=global_step)
@@ -316,32 +330,41 @@ class Trainer:
 
                 self.global_step += 1
 
+    @staticmethod
+    def _update_test_metrics(metrics, device_metrics_names, device_metrics_sum, n_batches):
+        if n_batches > 0:
+            metrics.update(zip(device_metrics_names, (device_metrics_sum / n_batches).tolist()))
+        metrics['lm_ppl'] = math.exp(metrics['lm_loss'])
+        metrics['s2s_ppl'] = math.exp(metrics['s2s_loss'])
+
     def _eval_test(self, metric_funcs={}, external_metrics_func=None, epoch=-1):
-        with torch.no_grad():
+        with torch.inference_mode(), torch.cuda.amp.autocast(enabled=self.fp16):
             self.model.eval()
 
-            tqdm_data = tqdm(self.test_dataloader, desc='Test')
+            tqdm_data = tqdm(CUDAPrefetcher(self.test_dataloader, self.device), desc='Test')
             metrics = {name: 0 for name in ('s2s_loss', 'lm_loss', 'hits_acc') + tuple(metric_funcs.keys())}
+            # lm_loss, s2s_loss and hits_acc are summed on the device and only read back for display and at the end
+            device_metrics_names = ('lm_loss', 's2s_loss', 'hits_acc')
+            device_metrics_sum = torch.zeros(len(device_metrics_names), dtype=torch.float, device=self.device)
+            n_batches = 0
             full_references, full_predictions = [], []
             for i, (contexts, targets, distractors) in enumerate(tqdm_data):
-                contexts, targets, distractors = [c.to(self.device) for c in contexts], targets.to(self.device), distractors.to(self.device)
-
                 negative_samples = len(distractors)//len(targets)
                 enc_contexts = []
 
                 # lm loss
                 batch_lm_loss = self._lm_loss(contexts, enc_contexts)
-                metrics['lm_loss'] = (metrics['lm_loss'] * i + batch_lm_loss.item()) / (i + 1)
 
                 # s2s loss on targets
                 batch_s2s_loss, hidden_state, padding_mask = self._s2s_loss(targets, enc_contexts,
                                                                             negative_samples)
-                metrics['s2s_loss'] = (metrics['s2s_loss'] * i + batch_s2s_loss.item()) / (i + 1)
 
                 # hits@1 loss on distractors and targets
                 batch_hits_acc = self._hist(distractors, hidden_state, padding_mask,
                                             enc_contexts, negative_samples)
-                metrics['hits_acc'] = (metrics['hits_acc'] * i + batch_hits_acc.item()) / (i + 1)
+
+                device_metrics_sum += torch.stack((batch_lm_loss, batch_s2s_loss, batch_hits_acc))
+                n_batches = i + 1
 
                 # full sequence loss
                 if self.evaluate_full_sequences:
@@ -367,9 +390,12 @@ class Trainer:
                         full_references.extend(string_targets)
                         full_predictions.extend(string_predictions)
 
-                metrics['lm_ppl'] = math.exp(metrics['lm_loss'])
-                metrics['s2s_ppl'] = math.exp(metrics['s2s_loss'])
-                tqdm_data.set_postfix(dict(**metrics))
+                # the device sums are read back on the first batch and then every 10 batches
+                if n_batches % 10 == 1:
+                    self._update_test_metrics(metrics, device_metrics_names, device_metrics_sum, n_batches)
+                    tqdm_data.set_postfix(dict(**metrics))
+
+            self._update_test_metrics(metrics, device_metrics_names, device_metrics_sum, n_batches)
 
             if external_metrics_func and self.evaluate_full_sequences:
                 external_metrics = external_metrics_func(full_references, full_predictions, epoch)
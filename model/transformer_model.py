@@ -16,16 +16,19 @@
 
 import logging
 import random
+from contextlib import ExitStack, contextmanager
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from .transformer_module import TransformerModule
-from .utils import repeat_along_dim1
+from .utils import repeat_along_dim1, select_along_dim0
 
 logger = logging.getLogger(__file__)
 
+_END_CHECK_STEPS = 8
+
 
 def apex_model(model, *, apex_level=None, optimizer=None, apex_loss_scale=None, num_losses=4):
     if apex_level is not None:
@@ -41,6 +44,21 @@ def apex_model(model, *, apex_level=None, optimizer=None, apex_loss_scale=None,
     return model if optimizer is None else (model, optimizer)
 
 
+@torch.jit.script
+def _update_beams(idxs, beam_idxs, is_end, beam_lens, n_embeddings: int, padding_idx: int, eos_id: int):
+    """ Beam search bookkeeping after the selection of the candidates idxs (batch, beam) among beam * n_embeddings,
+        scripted so that it runs as a few fused kernels instead of a launch per operation """
+    sym_idxs = idxs - beam_idxs * n_embeddings
+    is_end = torch.gather(is_end, 1, beam_idxs)
+    beam_lens = torch.gather(beam_lens, 1, beam_idxs)
+
+    sym_idxs = sym_idxs.masked_fill(is_end, padding_idx)
+    beam_lens = beam_lens + (~is_end).long()
+    is_end = is_end | (sym_idxs == eos_id)
+
+    return sym_idxs, is_end, beam_lens
+
+
 class MultipleChoiceHead(nn.Module):
     """ Classifier Head for the transformer """
 
@@ -66,6 +84,11 @@ class MultipleChoiceHead(nn.Module):
         return multiple_choice_logits
 
 
+def _unwrap_distributed(module):
+    " Module wrapped by a (torch or apex) DistributedDataParallel "
+    return module.module if type(module).__name__ == 'DistributedDataParallel' else module
+
+
 class TransformerModel(nn.Module):
     def __init__(self, n_layers, n_embeddings, n_pos_embeddings, embeddings_size, 
                  padding_idx, n_heads, dropout, embed_dropout, attn_dropout, ff_dropout,
@@ -74,7 +97,8 @@ class TransformerModel(nn.Module):
                  diversity_coef=0, diversity_groups=1, n_segments=None, multiple_choice_head=False,
                  single_input=False, dialog_embeddings=False, vocab=None, constant_embedding=False,
                  share_models=True, successive_attention=False, sparse_embeddings=False,
-                 shared_attention=True, context_size=2, bs_temperature=1, bs_nucleus_p=0):
+                 shared_attention=True, context_size=2, bs_temperature=1, bs_nucleus_p=0,
+                 bs_fp16=False, bs_low_precision=False, compile_embeddings=False, gradient_checkpointing=False):
 
         super(TransformerModel, self).__init__()
 
@@ -103,6 +127,8 @@ class TransformerModel(nn.Module):
 
         self.bs_temperature = bs_temperature
         self.bs_nucleus_p = bs_nucleus_p
+        self.bs_fp16 = bs_fp16
+        self.bs_low_precision = bs_low_precision
 
         self.vocab = vocab
 
@@ -113,7 +139,9 @@ class TransformerModel(nn.Module):
                                                     successive_attention=successive_attention,
                                                     sparse_embeddings=sparse_embeddings,
                                                     shared_attention=shared_attention,
-                                                    context_size=context_size)
+                                                    context_size=context_size,
+                                                    compile_embeddings=compile_embeddings,
+                                                    gradient_checkpointing=gradient_checkpointing)
         if not share_models:
             self.encoder_module = TransformerModule(n_layers, n_embeddings, n_pos_embeddings, embeddings_size, 
                                                     padding_idx, n_heads, dropout, embed_dropout, attn_dropout,
@@ -121,12 +149,19 @@ class TransformerModel(nn.Module):
                                                     constant_embedding=constant_embedding,
                                                     successive_attention=successive_attention,
                                                     sparse_embeddings=sparse_embeddings,
-                                                    shared_attention=shared_attention)
+                                                    shared_attention=shared_attention,
+                                                    compile_embeddings=compile_embeddings,
+                                                    gradient_checkpointing=gradient_checkpointing)
         self.pre_softmax = nn.Linear(embeddings_size, n_embeddings, bias=False)
         self.pre_softmax.weight = self.transformer_module.embeddings.weight
         self.multiple_choice_head = MultipleChoiceHead(self.embeddings_size, dropout) if multiple_choice_head else None
 
     def distribute(self, device):
+        """ One process per gpu (torch.distributed.launch), gradients are all-reduced by apex after each backward.
+            apex's DistributedDataParallel is kept: transformer_module runs several times per backward (contexts,
+            targets, distractors, risk beams), the tied pre_softmax is used outside of it and some parameters are
+            unused depending on the loss weights, which torch's reducer doesn't support with its default settings.
+        """
         try:
             from apex.parallel import DistributedDataParallel, convert_syncbn_model
         except ImportError:
@@ -142,28 +177,41 @@ class TransformerModel(nn.Module):
         self.multiple_choice_head = _distributed(self.multiple_choice_head.to(device)) \
             if self.multiple_choice_head is not None else None
 
+    @contextmanager
+    def no_sync(self):
+        " Disables gradients synchronization of torch distributed submodules, apex ones still all-reduce every backward "
+        with ExitStack() as stack:
+            for module in self.children():
+                if isinstance(module, nn.parallel.DistributedDataParallel):
+                    stack.enter_context(module.no_sync())
+            yield
+
+    def quantize_for_inference(self):
+        """ Dynamic int8 quantization of the linear layers for cpu inference (the model can't be trained or saved after).
+            pre_softmax gets its own quantized copy of the tied weights, the embeddings stay in float.
+            qkv_proj is kept in float as its weight is sliced for the attention over contexts. """
+        assert not self.training and next(self.parameters()).device.type == 'cpu'
+
+        names = {name for name, module in self.named_modules()
+                 if isinstance(module, nn.Linear) and not name.endswith('qkv_proj')}
+        return torch.quantization.quantize_dynamic(self, qconfig_spec=names, dtype=torch.qint8, inplace=True)
+
     def state_dict(self):
         state_dict = {}
         for k in dir(self):
             module = getattr(self, k)
             if isinstance(module, nn.Module):
-                if isinstance(module, nn.parallel.DistributedDataParallel):
-                    module = module.module
-
-                state_dict[k] = module.state_dict()
+                state_dict[k] = _unwrap_distributed(module).state_dict()
 
         return state_dict
 
     def load_state_dict(self, state_dict, strict=True):
         for k, v in state_dict.items():
             assert hasattr(self, k), f'Model does not have {k} submodule'
-            module = getattr(self, k)
-            if isinstance(module, nn.parallel.DistributedDataParallel):
-                module = module.module
-            module.load_state_dict(v, strict)
+            _unwrap_distributed(getattr(self, k)).load_state_dict(v, strict)
 
     def forward(self, x, contexts=[]):
-        enc_contexts = [self.encode(c) for c in contexts]
+        enc_contexts = self.encode_contexts(contexts)
         return self.decode(x, enc_contexts)
 
     def encode(self, x):
@@ -171,6 +219,24 @@ class TransformerModel(nn.Module):
         x, padding_mask, _ = self.transformer_module(x) if self.share_models else self.encoder_module(x)
         return x, padding_mask
 
+    def encode_contexts(self, contexts):
+        """ Encodes a list of contexts of the same batch size in a single pass: they are padded to the same length
+            and concatenated along the batch. Returns a list of tuple(x, padding_mask) with the original lengths. """
+        contexts = list(contexts)  # any iterable (e.g. the map built by the agent)
+        if len(contexts) < 2:
+            return [self.encode(c) for c in contexts]
+
+        batch_size = contexts[0].shape[0]
+        max_len = max(c.shape[1] for c in contexts)
+        fused = contexts[0].new_full((batch_size * len(contexts), max_len) + contexts[0].shape[2:], self.padding_idx)
+        for i, c in enumerate(contexts):
+            fused[i * batch_size:(i + 1) * batch_size, :c.shape[1]] = c
+
+        x, padding_mask = self.encode(fused)
+
+        return [(x[i * batch_size:(i + 1) * batch_size, :c.shape[1]],
+                 padding_mask[i * batch_size:(i + 1) * batch_size, :c.shape[1]]) for i, c in enumerate(contexts)]
+
     def generate(self, enc_x):
         return self.pre_softmax(enc_x)
 
@@ -191,7 +257,7 @@ class TransformerModel(nn.Module):
             enc_contexts = []
             beam_starts = contexts
         else:
-            enc_contexts = [self.encode(c) for c in contexts]
+            enc_contexts = self.encode_contexts(contexts)
             beam_starts = None
         prediction = self.beam_search(enc_contexts=enc_contexts, beam_starts=beam_starts)
 
@@ -214,165 +280,249 @@ class TransformerModel(nn.Module):
             assert self.annealing_topk is None
 
             sorted_probas, idxs = torch.sort(probas, descending=True, dim=-1)
-            skip_mask = torch.cumsum(sorted_probas.cumsum(dim=-1) > self.bs_nucleus_p, dim=-1) > 1
+            skip_mask = torch.cumsum(sorted_probas.cumsum(dim=-1, dtype=torch.float) > self.bs_nucleus_p, dim=-1) > 1
             sorted_probas.masked_fill_(skip_mask, 0.0)
             _, idxs = torch.sort(idxs, dim=-1)
             probas = torch.gather(sorted_probas, -1, idxs)
             skip_mask = torch.gather(skip_mask, -1, idxs)
 
-        beam_scores = beam_scores.unsqueeze(-1) + torch.log(probas) * (1 - is_end.float().unsqueeze(-1))
+        # the accumulation is done in fp32 even when the per step probabilities are stored in lower precision
+        scores = beam_scores.unsqueeze(-1) + torch.log(probas).float()
 
         if skip_mask is not None:
-            beam_scores.masked_fill_(skip_mask, float('-inf'))
-
-        return beam_scores
-
-    def _sample(self, beam_scores, num_samples, sample_prob=1.):
-        if random.random() < sample_prob:
-            beam_probas = F.softmax(beam_scores, dim=-1)
-            if self.annealing_topk is not None:
-                beam_probas, sample_idxs = beam_probas.topk(self.annealing_topk, dim=-1)
-                idxs = torch.multinomial(beam_probas, num_samples)
-                idxs = torch.gather(sample_idxs, 1, idxs)
-            else:
-                idxs = torch.multinomial(beam_probas, num_samples)
-            scores = torch.gather(beam_scores, 1, idxs)
+            scores.masked_fill_(skip_mask, float('-inf'))
+
+        # a finished beam has a single candidate, itself extended with padding and with an unchanged score
+        scores.masked_fill_(is_end.unsqueeze(-1), float('-inf'))
+        scores[:, :, self.padding_idx] = torch.where(is_end, beam_scores, scores[:, :, self.padding_idx])
+
+        return scores
+
+    @staticmethod
+    def _gumbel_topk(scores, num_samples, sample_mask=None):
+        " Samples num_samples indices without replacement from softmax(scores), without computing the softmax "
+        gumbels = -torch.empty_like(scores).exponential_().log()
+        if sample_mask is not None:
+            gumbels = gumbels.masked_fill(~sample_mask, 0)  # rows without noise are a plain topk
+        return (scores + gumbels).topk(num_samples, dim=-1)[1]
+
+    def _sample(self, beam_scores, num_samples, sample_prob=1., n_groups=1):
+        " Rows are n_groups interleaved groups (row r belongs to the group r % n_groups), each one sampled independently "
+        sampled = [random.random() < sample_prob for _ in range(n_groups)]
+        if not any(sampled):
+            return beam_scores.topk(num_samples, dim=-1)
+
+        sample_mask = None
+        if not all(sampled):
+            sample_mask = torch.tensor(sampled, dtype=torch.bool, device=beam_scores.device)
+            sample_mask = sample_mask.repeat(beam_scores.shape[0] // n_groups).unsqueeze(-1)
+
+        if self.annealing_topk is not None:
+            top_scores, sample_idxs = beam_scores.topk(self.annealing_topk, dim=-1)
+            idxs = self._gumbel_topk(top_scores, num_samples, sample_mask)
+            idxs = torch.gather(sample_idxs, 1, idxs)
         else:
-            scores, idxs = beam_scores.topk(num_samples, dim=-1)
+            idxs = self._gumbel_topk(beam_scores, num_samples, sample_mask)
+        scores = torch.gather(beam_scores, 1, idxs)
 
         return scores, idxs
 
-    def _fix_past(self, past, beam_idxs):
-        for layer_output in past:
-            for context in layer_output:
-                for v in context:
-                    size_ = v.size()
-                    tile_size = size_[-2] * size_[-1]
-                    new_v = v.contiguous().view(-1, self.beam_size, tile_size)
-                    new_v = new_v.gather(1, beam_idxs.unsqueeze(-1).repeat([1, 1, tile_size]))
-                    v[...] = new_v.view(*size_)
-        return past
+    def _flat_beam_idxs(self, beam_idxs):
+        " (batch * beam) rows of the flattened tensors selected by the per item beam_idxs "
+        batch_size = beam_idxs.shape[0]
+        offsets = torch.arange(batch_size, device=beam_idxs.device).unsqueeze(1) * self.beam_size
+        return (beam_idxs + offsets).view(-1)
+
+    def _fix_past(self, past, flat_idxs):
+        # only the self-attention keys/values (first entry of each layer) depend on the beam,
+        # the encoded contexts keys/values are computed once, at batch size, and shared by the beams of an item
+        return [[select_along_dim0(layer_output[0], flat_idxs)] + list(layer_output[1:]) for layer_output in past]
+
+    def _beam_rows(self, batch_idxs):
+        " Rows of the (batch * beam) flattened tensors which belong to the batch items batch_idxs "
+        beam_range = torch.arange(self.beam_size, device=batch_idxs.device)
+        return (batch_idxs.unsqueeze(1) * self.beam_size + beam_range).view(-1)
 
     def beam_search(self, enc_contexts=[], return_beams=False, beam_starts=None):
-        with torch.no_grad():
+        device = next(self.parameters()).device
+        # with bs_fp16 the decoder runs in fp16 on gpu, the beam scores are always accumulated in fp32,
+        # bs_low_precision only stores the (batch, beam, vocab) per step probabilities in bf16
+        use_amp = self.bs_fp16 and device.type == 'cuda'
+        probs_dtype = torch.bfloat16 if self.bs_low_precision else torch.float32
+        with torch.inference_mode():
             if len(enc_contexts) == 0 and beam_starts is None:
                 return []
 
             batch_size = enc_contexts[0][0].shape[0] if beam_starts is None else beam_starts.shape[0]
-            device = next(self.parameters()).device
-
-            prevs = torch.full((batch_size * self.beam_size, 1), fill_value=self.bos_id, dtype=torch.long, device=device)
 
             beam_scores = torch.zeros(batch_size, self.beam_size, device=device)
             beam_lens = torch.ones(batch_size, self.beam_size, dtype=torch.long, device=device)
-            is_end = torch.zeros(batch_size, self.beam_size, dtype=torch.uint8, device=device)
+            is_end = torch.zeros(batch_size, self.beam_size, dtype=torch.bool, device=device)
 
             if beam_starts is not None:
                 beam_starts = repeat_along_dim1(beam_starts, self.beam_size)
-            beam_enc_contexts = repeat_along_dim1(enc_contexts, self.beam_size)
+            beam_enc_contexts = enc_contexts  # not repeated, the attention broadcasts them over the beams
 
             current_sample_prob = 1
             group_size = self.beam_size // self.diversity_groups
             diversity_penalty = torch.zeros((batch_size, self.n_embeddings), device=device)
             past = None
 
-            max_seq_len = min(self.n_pos_embeddings - prevs.shape[1] - (beam_starts.shape[1] if beam_starts is not None else 0),
+            max_seq_len = min(self.n_pos_embeddings - 1 - (beam_starts.shape[1] if beam_starts is not None else 0),
                               self.max_seq_len)
 
+            # the generated tokens are written in place into a buffer allocated once, cur_len columns are filled
+            prevs_buf = torch.full((batch_size * self.beam_size, max_seq_len + 1), fill_value=self.padding_idx,
+                                   dtype=torch.long, device=device)
+            prevs_buf[:, 0] = self.bos_id
+            cur_len = 1
+
+            # finished batch items are removed from the decoding tensors and kept aside with their position in the batch
+            full_batch_size = batch_size
+            batch_idxs = torch.arange(batch_size, device=device)
+            finished = []
+            # selection keeping each beam in place, extended with padding
+            beam_range = torch.arange(self.beam_size, device=device)
+            frozen_idxs = beam_range * self.n_embeddings + self.padding_idx
+
             for i in range(max_seq_len):
-                inputs = prevs[:, -1:, ...]  # only use the last token (rest is in past)
+                inputs = prevs_buf[:, cur_len-1:cur_len]  # only use the last token (rest is in past)
                 if self.dialog_embeddings and inputs.dim() < 3:
                     inputs = torch.stack((inputs, torch.full_like(inputs, self.sent_dialog_id)), dim=inputs.dim())
                 if i == 0 and beam_starts is not None:
                     inputs = torch.cat((beam_starts, inputs), dim=1)
 
-                outputs, _, past = self.transformer_module(inputs, beam_enc_contexts, past=past)
+                with torch.cuda.amp.autocast(enabled=use_amp, dtype=torch.float16):
+                    outputs, _, past = self.transformer_module(inputs, beam_enc_contexts, past=past)
+                    logits = self.generate(outputs[:, -1, :])
 
-                logits = self.generate(outputs[:, -1, :])
-
-                probs = self._get_proba_with_temperature(logits.float())
+                probs = self._get_proba_with_temperature(logits.float()).to(probs_dtype)
                 probs = probs.view(batch_size, self.beam_size, -1)
 
-                beam_scores = self._get_beam_scores(probs, beam_scores, is_end)
+                # beam_scores stay raw log-probabilities, the length (and diversity) penalties are only used for selection
+                raw_scores = self._get_beam_scores(probs, beam_scores, is_end)
                 penalty = self._length_penalty(beam_lens.float() + 1 - is_end.float()).unsqueeze(-1)
-                beam_scores = beam_scores / penalty
+                scores = raw_scores / penalty
+                prev_beam_scores = beam_scores
 
                 if i == 0:
-                    penalty = penalty[:, 0, :]
-                    beam_scores = beam_scores[:, 0, :]
-
-                    beam_scores, idxs = beam_scores.topk(self.beam_size, dim=-1)
+                    _, idxs = scores[:, 0, :].topk(self.beam_size, dim=-1)
+                    beam_scores = torch.gather(raw_scores[:, 0, :], 1, idxs)
                     beam_idxs = torch.zeros((batch_size, self.beam_size), dtype=torch.long, device=device)
+                elif self.diversity_coef == 0 or self.diversity_groups == 1:
+                    # without diversity penalty the groups are independent: they are selected as a single batch
+                    scores = scores.view(batch_size * self.diversity_groups, -1)
+                    _, idxs = self._sample(scores, group_size, sample_prob=current_sample_prob,
+                                           n_groups=self.diversity_groups)
+                    group_offsets = torch.arange(self.diversity_groups, device=device) * group_size * self.n_embeddings
+                    idxs = (idxs.view(batch_size, self.diversity_groups, group_size) + group_offsets.view(1, -1, 1)).view(batch_size, -1)
+                    beam_scores = torch.gather(raw_scores.view(batch_size, -1), 1, idxs)
+
+                    beam_idxs = torch.div(idxs, self.n_embeddings, rounding_mode='floor')
                 else:
                     penalty = penalty.view(batch_size, self.diversity_groups, group_size, -1)
-                    beam_scores = beam_scores.view(batch_size, self.diversity_groups, group_size, -1)
+                    scores = scores.view(batch_size, self.diversity_groups, group_size, -1)
 
-                    all_scores, all_idxs = [], []
+                    all_idxs = []
+                    group_ones = diversity_penalty.new_ones((batch_size, group_size))
                     for g in range(self.diversity_groups):
-                        g_beam_scores = beam_scores[:, g, :, :]
+                        g_scores = scores[:, g, :, :]
                         g_penalty = penalty[:, g, :, :]
-                        g_beam_scores -= self.diversity_coef * diversity_penalty.unsqueeze(1) / g_penalty
-                        g_beam_scores = g_beam_scores.view(batch_size, -1)
+                        g_scores = g_scores - self.diversity_coef * diversity_penalty.unsqueeze(1) / g_penalty
+                        g_scores = g_scores.view(batch_size, -1)
 
-                        g_scores, g_idxs = self._sample(g_beam_scores, group_size, sample_prob=current_sample_prob)
+                        _, g_idxs = self._sample(g_scores, group_size, sample_prob=current_sample_prob)
                         g_idxs += g * group_size * self.n_embeddings
 
-                        all_scores.append(g_scores)
                         all_idxs.append(g_idxs)
 
-                        diversity_penalty.scatter_add_(1,
-                                                       torch.fmod(g_idxs, self.n_embeddings),
-                                                       torch.ones((batch_size, group_size), device=device))
+                        diversity_penalty.scatter_add_(1, torch.fmod(g_idxs, self.n_embeddings), group_ones)
 
                     diversity_penalty.fill_(0)
-                    penalty = penalty.view(batch_size, -1)
-                    beam_scores = torch.cat(all_scores, dim=-1)
-                    idxs = torch.cat(all_idxs, dim=-1) 
+                    idxs = torch.cat(all_idxs, dim=-1)
+                    beam_scores = torch.gather(raw_scores.view(batch_size, -1), 1, idxs)
+
+                    beam_idxs = torch.div(idxs, self.n_embeddings, rounding_mode='floor')
 
-                    beam_idxs = (idxs.float() / self.n_embeddings).long()
+                if i > 0:
+                    # items whose beams are all finished wait for the next end check frozen: these steps are no-ops
+                    frozen = is_end.all(dim=-1, keepdim=True)
+                    idxs = torch.where(frozen, frozen_idxs, idxs)
+                    beam_idxs = torch.where(frozen, beam_range, beam_idxs)
+                    beam_scores = torch.where(frozen, prev_beam_scores, beam_scores)
 
-                sym_idxs = torch.fmod(idxs, probs.shape[-1])
-                is_end = torch.gather(is_end, 1, beam_idxs)
-                beam_lens = torch.gather(beam_lens, 1, beam_idxs)
+                sym_idxs, is_end, beam_lens = _update_beams(idxs, beam_idxs, is_end, beam_lens,
+                                                            self.n_embeddings, self.padding_idx, self.eos_id)
 
                 if self.vocab is not None:
-                    logger.info('\nbeams:\n' + '\n'.join(self.vocab.ids2string(t.detach().cpu().tolist()) for t in prevs))
+                    logger.info('\nbeams:\n' + '\n'.join(self.vocab.ids2string(t.detach().cpu().tolist()) for t in prevs_buf[:, :cur_len]))
                     logger.info('\ntop-options:\n' + '\n'.join(self.vocab.ids2string(t.detach().cpu().tolist())
                                 + str(bi.detach().cpu().tolist()) for t, bi in zip(sym_idxs, beam_idxs)))
 
-                sym_idxs[is_end] = self.padding_idx
-                beam_lens[~is_end] += 1
-                is_end[sym_idxs == self.eos_id] = 1
-
-                sym_idxs = sym_idxs.view(batch_size * self.beam_size, 1)
-                prevs = prevs.view(batch_size, self.beam_size, -1)
-                prevs = torch.gather(prevs, 1, beam_idxs.unsqueeze(-1).repeat(1, 1, prevs.shape[-1]))
-                prevs = prevs.view(batch_size * self.beam_size, -1)
-                prevs = torch.cat([prevs, sym_idxs], dim=1)
-
-                past = self._fix_past(past, beam_idxs)
+                flat_idxs = self._flat_beam_idxs(beam_idxs)
+                prevs_buf[:, :cur_len] = prevs_buf[:, :cur_len].index_select(0, flat_idxs)
+                prevs_buf[:, cur_len] = sym_idxs.view(-1)
+                cur_len += 1
+
+                past = self._fix_past(past, flat_idxs)
+
+                # reading the finished items back syncs with the device, it is only done every few steps:
+                # in between, the finished items stay frozen
+                if (i + 1) % _END_CHECK_STEPS == 0:
+                    done = is_end.all(dim=-1)
+                    n_done = done.sum().item()
+                    if n_done == batch_size:
+                        break
+
+                    if 2 * n_done > batch_size:
+                        done_idxs, live_idxs = done.nonzero().squeeze(-1), (~done).nonzero().squeeze(-1)
+                        finished.append((batch_idxs[done_idxs], prevs_buf[:, :cur_len].view(batch_size, self.beam_size, -1)[done_idxs],
+                                         beam_scores[done_idxs], beam_lens[done_idxs]))
+
+                        live_rows = self._beam_rows(live_idxs)
+                        prevs_buf = prevs_buf.index_select(0, live_rows)
+                        # self-attention caches have a row per beam, contexts ones a row per batch item
+                        past = [[select_along_dim0(layer_output[0], live_rows)] + select_along_dim0(list(layer_output[1:]), live_idxs)
+                                for layer_output in past]
+                        beam_enc_contexts = select_along_dim0(beam_enc_contexts, live_idxs)
+                        batch_idxs, beam_scores, beam_lens, is_end, diversity_penalty = \
+                            (t[live_idxs] for t in (batch_idxs, beam_scores, beam_lens, is_end, diversity_penalty))
+                        batch_size = len(live_idxs)
 
-                if all(is_end.view(-1)):
-                    break
-
-                beam_scores *= penalty
                 current_sample_prob *= self.annealing
 
+            prevs = prevs_buf[:, :cur_len]
+            if finished:
+                # scatter the finished and remaining items back to their positions, padding the shorter beams
+                finished.append((batch_idxs, prevs.view(batch_size, self.beam_size, -1), beam_scores, beam_lens))
+                max_len = max(f[1].shape[-1] for f in finished)
+                prevs = torch.full((full_batch_size, self.beam_size, max_len), fill_value=self.padding_idx,
+                                   dtype=torch.long, device=device)
+                beam_scores = torch.zeros(full_batch_size, self.beam_size, device=device)
+                beam_lens = torch.ones(full_batch_size, self.beam_size, dtype=torch.long, device=device)
+                for f_idxs, f_prevs, f_scores, f_lens in finished:
+                    prevs[f_idxs, :, :f_prevs.shape[-1]] = f_prevs
+                    beam_scores[f_idxs] = f_scores
+                    beam_lens[f_idxs] = f_lens
+                batch_size = full_batch_size
+
             predicts = []
             result = prevs.view(batch_size, self.beam_size, -1)
 
             if return_beams:
                 return result, beam_lens
 
+            beam_scores = beam_scores / self._length_penalty(beam_lens.float())
             if self.sample:
                 probs = F.softmax(beam_scores, dim=-1)
                 bests = torch.multinomial(probs, 1).view(-1)
             else:
                 bests = beam_scores.argmax(dim=-1)
-            
-            for i in range(batch_size):
-                best_len = beam_lens[i, bests[i]]
-                best_seq = result[i, bests[i], 1:best_len-1]
-                predicts.append(best_seq.tolist())
-                
+
+            # a single device to host copy for the whole batch
+            best_seqs = result.gather(1, bests.view(-1, 1, 1).expand(-1, 1, result.shape[-1])).squeeze(1).tolist()
+            best_lens = beam_lens.gather(1, bests.view(-1, 1)).squeeze(1).tolist()
+            for best_seq, best_len in zip(best_seqs, best_lens):
+                predicts.append(best_seq[1:best_len-1])
+
         return predicts
@@ -20,6 +20,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .utils import checkpoint_sequential
 
@@ -31,19 +32,24 @@ except ImportError:
     print("Better speed can be achieved with apex installed from https://www.github.com/nvidia/apex.")
     from torch.nn import LayerNorm
 
+# fused attention kernels (flash / memory efficient) when available (pytorch >= 2.0)
+_USE_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
 
 class ConstantPositionalEmbedding(nn.Module):
-    def __init__(self, embedding_dim, padding_idx):
+    def __init__(self, embedding_dim, padding_idx, max_positions=1024, dtype=torch.float32):
         super(ConstantPositionalEmbedding, self).__init__()
 
         self.embedding_dim = embedding_dim
         self.padding_idx = padding_idx
         self.register_buffer('_position_embedding',
-                             ConstantPositionalEmbedding.get_embedding(1024,
-                                                                       self.embedding_dim))
+                             ConstantPositionalEmbedding.get_embedding(max_positions,
+                                                                       self.embedding_dim,
+                                                                       dtype=dtype))
 
     @classmethod
-    def get_embedding(cls, seq_len, embedding_dim, device=None):
+    def get_embedding(cls, seq_len, embedding_dim, device=None, dtype=torch.float32):
+        " The sinusoids are always computed in float32 and only then casted to dtype "
         seq_len += 1
 
         half_dim = embedding_dim // 2
@@ -54,21 +60,27 @@ class ConstantPositionalEmbedding(nn.Module):
         emb = torch.cat([torch.sin(emb), torch.cos(emb)], dim=1).view(seq_len, -1)
 
         if embedding_dim % 2:
-            emb = torch.cat([emb, torch.zeros(seq_len, 1)], dim=1)
+            emb = torch.cat([emb, torch.zeros(seq_len, 1, device=device)], dim=1)
 
-        return emb
+        return emb.to(dtype)
 
-    def forward(self, positions):
+    def forward(self, positions, max_position=None):
         batch_size, seq_len = positions.size()
 
-        cur_seq_len = max(seq_len, torch.max(positions).item())
+        if max_position is None:
+            max_position = torch.max(positions).item()
+        cur_seq_len = max(seq_len, max_position)
 
         if cur_seq_len >= self._position_embedding.size(0):
-            self._position_embedding = ConstantPositionalEmbedding.get_embedding(cur_seq_len,
-                                                                                 self.embedding_dim,
-                                                                                 positions.device)
+            # keep the current dtype of the table (e.g. after model.half()),
+            # and never store an inference tensor since the table is reused in training
+            with torch.inference_mode(False):
+                self._position_embedding = ConstantPositionalEmbedding.get_embedding(cur_seq_len,
+                                                                                     self.embedding_dim,
+                                                                                     positions.device,
+                                                                                     self._position_embedding.dtype)
 
-        return self._position_embedding.index_select(0, positions.view(-1)).view(batch_size, seq_len, -1)
+        return F.embedding(positions, self._position_embedding)
 
 
 class MultiheadAttention(nn.Module):
@@ -77,7 +89,8 @@ class MultiheadAttention(nn.Module):
         nd, ns = size
         max_size = max(nd, ns)
         if not hasattr(cls, '_future_mask') or cls._future_mask.device != device or any(s<max_size for s in cls._future_mask.shape):
-            cls._future_mask = torch.triu(torch.ones(max_size, max_size, dtype=torch.uint8, device=device), 1)
+            with torch.inference_mode(False):  # the cached mask must stay usable outside of inference mode
+                cls._future_mask = torch.triu(torch.ones(max_size, max_size, dtype=torch.bool, device=device), 1)
 
         mask = cls._future_mask[ns-nd:ns, :ns]  # future mask when we already may have past pre-computed values: take a slice at the end of the mask
 
@@ -125,6 +138,26 @@ class MultiheadAttention(nn.Module):
 
         return out
 
+    def _sdpa_attn(self, q, k, v, apply_future_mask=True, padding_mask=None):
+        # same as _attn with a fused kernel, but keys are not transposed: (bsz, n_heads, seq_len, head_dim)
+        keep_mask = None
+        if apply_future_mask:
+            keep_mask = ~MultiheadAttention._get_future_mask((q.shape[-2], k.shape[-2]), q.device)
+
+        if padding_mask is not None:
+            padding_keep_mask = ~padding_mask.bool().unsqueeze(1).unsqueeze(2)
+            keep_mask = padding_keep_mask if keep_mask is None else keep_mask & padding_keep_mask
+
+        dropout_p = self.dropout.p if self.training else 0.0
+        if keep_mask is None:
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+
+        # fully masked rows would give nans: they attend to everything and their output is zeroed afterwards
+        empty_mask = ~keep_mask.any(dim=-1, keepdim=True)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=keep_mask | empty_mask, dropout_p=dropout_p)
+
+        return out.masked_fill(empty_mask, 0)
+
     def _merge_heads(self, x):
         x = x.permute(0, 2, 1, 3).contiguous()
         x = x.view(x.shape[0], x.shape[1], self.n_features)
@@ -160,13 +193,25 @@ class MultiheadAttention(nn.Module):
         save_key_value = (key, value)
         save_query = query
 
+        # contexts may be shared by several consecutive queries (e.g. the beams of beam search): these queries are
+        # folded along the length dimension so that keys/values are broadcasted instead of being repeated
+        query_batch_size, query_len = query.shape[:2]
+        n_repeats = query_batch_size // key.shape[0]
+        if n_repeats > 1:
+            assert not apply_future_mask and query_batch_size == n_repeats * key.shape[0]
+            query = query.reshape(key.shape[0], n_repeats * query_len, self.n_features)
+
         query = self._split_heads(query)
-        key = self._split_heads(key, is_key=True)
+        key = self._split_heads(key, is_key=not _USE_SDPA)
         value = self._split_heads(value)
 
-        x = self._attn(query, key, value, apply_future_mask, padding_mask)
+        attn = self._sdpa_attn if _USE_SDPA else self._attn
+        x = attn(query, key, value, apply_future_mask, padding_mask)
         x = self._merge_heads(x)
 
+        if n_repeats > 1:
+            x = x.view(query_batch_size, query_len, self.n_features)
+
         x = self.out_proj(x)
 
         return x, save_key_value, save_query # we can reuse: key/value for next forward steps, query for next attention ops
@@ -249,7 +294,7 @@ class TransformerBlock(nn.Module):
             layer_past = [None] * (len(inputs) // 2)
 
         for i, attn_past_kv in zip(range(0, len(inputs), 2), layer_past):
-            c, m = inputs[i], inputs[i+1].byte()
+            c, m = inputs[i], inputs[i+1].bool()
 
             if self.shared_attention or i == 0:
                 attn = self.attn
@@ -265,7 +310,9 @@ class TransformerBlock(nn.Module):
                 a = self.dropout(a)
                 x = a + x if i == 0 else self.gated_res(a, x)
         else:
-            a = sum(result_attns, 0) / len(result_attns)
+            a = result_attns[0]
+            if len(result_attns) > 1:
+                a = sum(result_attns[1:], a) / len(result_attns)
             a = self.dropout(a)
             x = x + a
 
@@ -283,7 +330,8 @@ class TransformerModule(nn.Module):
                  padding_idx, n_heads, dropout, embed_dropout, attn_dropout, ff_dropout,
                  normalize_embeddings, n_segments=None, constant_embedding=False,
                  successive_attention=False, sparse_embeddings=False,
-                 shared_attention=True, context_size=0):
+                 shared_attention=True, context_size=0, compile_embeddings=False,
+                 gradient_checkpointing=False):
         super(TransformerModule, self).__init__()
 
         self._constant_embedding = constant_embedding
@@ -300,6 +348,13 @@ class TransformerModule(nn.Module):
                                      for _ in range(n_layers)])
         self.n_segments = n_segments
         self.normalize_embeddings = normalize_embeddings
+        self.gradient_checkpointing = gradient_checkpointing
+        self._embeddings_scale = math.sqrt(embeddings_size)
+
+        if compile_embeddings:
+            assert hasattr(torch, 'compile'), 'Compiling the embeddings requires PyTorch >= 2.0'
+            assert not sparse_embeddings, 'Compiled embeddings don\'t support sparse gradients'
+            self._embed = torch.compile(self._embed, dynamic=True)
 
         self._init_weights()
 
@@ -308,26 +363,40 @@ class TransformerModule(nn.Module):
         if isinstance(self.pos_embeddings, nn.Embedding):
             nn.init.normal_(self.pos_embeddings.weight, std=0.02)
 
-    def forward(self, x, enc_contexts=[], past=None):
-        # x.dim() == 3 if we have additional dialog embeddings else x.dim() == 2
-        if past is None: # past store previously computed keys/values for the current generated sentence
-            past_length = 0
-            past = [None] * len(self.layers)
-        else:
-            past_length = past[0][0][0].size(-2)  # layer 0, attn ops 0, key (0)
-
+    def _embed(self, x, past_length):
+        " Sum of token (and dialog) embeddings with positional embeddings, returns a tuple(x, padding_mask) "
         padding_mask = (x[:, :, 0] if x.dim() == 3 else x).eq(self.embeddings.padding_idx)
 
-        positions = torch.cumsum(~padding_mask, dim=-1, dtype=torch.long) + past_length
+        positions = torch.cumsum(~padding_mask, dim=-1, dtype=torch.long)
+        if past_length:
+            positions += past_length
         positions.masked_fill_(padding_mask, self.pos_embeddings.padding_idx)
 
         x = self.embeddings(x)
         if x.dim() == 4: # additional dialog embeddings
             x = x.sum(dim=-2)
         if self.normalize_embeddings:
-            x = x * math.sqrt(self.embeddings.embedding_dim)  # Used in pretrained last checkpoint for ConvAI2
+            x = x.mul_(self._embeddings_scale)  # Used in pretrained last checkpoint for ConvAI2
+
+        if self._constant_embedding:
+            # positions never exceed past_length + seq_len: pass the bound to avoid a device sync on positions.max()
+            x += self.pos_embeddings(positions, max_position=past_length + positions.size(1))
+        else:
+            # direct functional lookup: skips the nn.Module call machinery on every step
+            x += F.embedding(positions, self.pos_embeddings.weight, self.pos_embeddings.padding_idx,
+                             sparse=self.pos_embeddings.sparse)
+
+        return x, padding_mask
+
+    def forward(self, x, enc_contexts=[], past=None):
+        # x.dim() == 3 if we have additional dialog embeddings else x.dim() == 2
+        if past is None: # past store previously computed keys/values for the current generated sentence
+            past_length = 0
+            past = [None] * len(self.layers)
+        else:
+            past_length = past[0][0][0].size(-2)  # layer 0, attn ops 0, key (0)
 
-        x += self.pos_embeddings(positions)
+        x, padding_mask = self._embed(x, past_length)
         x = self.embed_dropout(x)
 
         enc_contexts = sum(enc_contexts, ())
@@ -339,9 +408,15 @@ class TransformerModule(nn.Module):
             out = checkpoint_sequential(self.layers, self.n_segments, x, padding_mask, *enc_contexts)
             x = out[0]
         else:
+            # activations of the blocks are recomputed during backward instead of being stored
+            use_checkpointing = self.gradient_checkpointing and self.training and torch.is_grad_enabled()
+
             save_key_values = []
             for layer, layer_past in zip(self.layers, past):
-                out = layer(x, padding_mask, *enc_contexts, layer_past=layer_past)
+                if use_checkpointing and layer_past is None:
+                    out = checkpoint(layer, x, padding_mask, *enc_contexts, use_reentrant=False)
+                else:
+                    out = layer(x, padding_mask, *enc_contexts, layer_past=layer_past)
                 x = out[0]
                 save_key_values.append(out[-1])
 
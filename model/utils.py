@@ -55,6 +55,16 @@ def repeat_along_dim1(obj, repetitions):
     return obj.view(-1, *obj.size()[2:])
 
 
+def select_along_dim0(obj, idxs):
+    """ index_select (a possibly nested object of) tensors along their first dimension """
+    if isinstance(obj, tuple):
+        return tuple(select_along_dim0(o, idxs) for o in obj)
+    if isinstance(obj, list):
+        return list(select_along_dim0(o, idxs) for o in obj)
+
+    return obj.index_select(0, idxs)
+
+
 def pad_sequence(sequences, batch_first=False, padding_value=0, left=False):
     # assuming trailing dimensions and type of all the Tensors
     # in sequences are same and fetching those from sequences[0]
@@ -67,7 +77,7 @@ def pad_sequence(sequences, batch_first=False, padding_value=0, left=False):
     else:
         out_dims = (max_len, len(sequences)) + trailing_dims
 
-    out_tensor = sequences[0].data.new(*out_dims).fill_(padding_value)
+    out_tensor = sequences[0].new_full(out_dims, padding_value)
     for i, tensor in enumerate(sequences):
         length = tensor.size(0)
         s_slice = slice(-length, None) if left else slice(None, length)
@@ -77,6 +87,58 @@ def pad_sequence(sequences, batch_first=False, padding_value=0, left=False):
     return out_tensor
 
 
+def move_to_device(obj, device, non_blocking=False):
+    """ move (a possibly nested object of) tensors to device """
+    if isinstance(obj, tuple):
+        return tuple(move_to_device(o, device, non_blocking) for o in obj)
+    if isinstance(obj, list):
+        return list(move_to_device(o, device, non_blocking) for o in obj)
+
+    return obj.to(device, non_blocking=non_blocking)
+
+
+def _record_stream(obj, stream):
+    if isinstance(obj, (tuple, list)):
+        for o in obj:
+            _record_stream(o, stream)
+    else:
+        obj.record_stream(stream)
+
+
+class CUDAPrefetcher:
+    """ Iterates over a data loader, copying the next batch to the gpu on a side stream
+        while the current one is processed. Batches are simply moved to the device on cpu. """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield move_to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = move_to_device(next_batch, self.device, non_blocking=True)
+            if batch is not None:
+                yield batch
+
+            # the batch is allocated on the side stream but consumed on the compute one
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            _record_stream(next_batch, current_stream)
+            batch = next_batch
+
+        if batch is not None:
+            yield batch
+
+
 def checkpoint_sequential(functions, segments, *inputs):
     def run_function(start, end, functions):
         def forward(*inputs):
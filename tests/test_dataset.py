@@ -0,0 +1,78 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('nltk')
+
+from model.dataset import FacebookDataset
+
+DIALOGS = '''1 your persona: i like cats.
+2 your persona: i live in paris.
+3 hello there\thi , how are you ?\t\tno|maybe later|hi , how are you ?
+4 fine thanks\tgood to hear\t\tcats|dogs|good to hear
+1 your persona: i am tall.
+2 what is up\tnothing much\t\tsure|why not|nothing much
+'''
+
+
+class CharVocab:
+    " Minimal vocab: one id per character "
+    pad_id, bos_id, eos_id, info_bos_id, info_eos_id = 0, 1, 2, 3, 4
+    talker1_bos_id, talker1_eos_id, talker2_bos_id, talker2_eos_id = 5, 6, 7, 8
+    sent_dialog_id, info_dialog_id, talker1_dialog_id, talker2_dialog_id = 9, 10, 11, 12
+
+    def string2ids(self, string):
+        return [13 + ord(c) % 64 for c in string]
+
+    def strings2ids(self, strings):
+        return [self.string2ids(s) for s in strings]
+
+
+@pytest.fixture
+def dialogs_path(tmp_path):
+    path = tmp_path / 'dialogs.txt'
+    path.write_text(DIALOGS, encoding='utf-8')
+    return str(path)
+
+
+def _dataset(path, **kwargs):
+    return FacebookDataset(path, CharVocab(), max_lengths=32, dialog_embeddings=True, negative_samples=2, **kwargs)
+
+
+def _assert_same_sample(sample, expected):
+    for t, e in zip(sample, expected):
+        assert torch.equal(t, e)
+
+
+def test_cached_samples_match_samples_built_on_the_fly(dialogs_path):
+    dataset = _dataset(dialogs_path)
+    data = FacebookDataset.make_dataset(FacebookDataset.parse_data(dialogs_path), CharVocab())
+
+    assert len(dataset) == len(data) == 3
+    for idx, (persona_info, dialog, _) in enumerate(data):
+        persona_info_t, h, y, distractors = dataset[idx]
+        _assert_same_sample((persona_info_t, h, y), dataset._make_sample(persona_info, dialog))
+        assert len(distractors) == 2
+
+
+def test_samples_are_persisted_in_the_cache_file(dialogs_path, tmp_path):
+    cache = str(tmp_path / 'cache.bin')
+    with torch.inference_mode():  # e.g. a test dataset created during an evaluation
+        dataset = _dataset(dialogs_path, cache=cache)
+    assert not any(t.is_inference() for sample in dataset._samples_cache for t in sample)
+
+    cached_dataset = _dataset(dialogs_path, cache=cache)
+    for sample, cached_sample in zip(dataset._samples_cache, cached_dataset._samples_cache):
+        _assert_same_sample(cached_sample, sample)
+
+    # samples built with other parameters are not reused
+    other_dataset = FacebookDataset(dialogs_path, CharVocab(), max_lengths=8, dialog_embeddings=True, cache=cache)
+    assert all(len(h) <= 8 for _, h, _ in other_dataset._samples_cache)
+
+
+def test_limited_datasets_do_not_persist_their_samples(dialogs_path, tmp_path):
+    cache = str(tmp_path / 'cache.bin')
+    limited = _dataset(dialogs_path, cache=cache, limit_size=2)
+    assert len(limited) == 2
+
+    assert torch.load(cache)['samples'] == {}
+    assert len(_dataset(dialogs_path, cache=cache)) == 3
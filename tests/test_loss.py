@@ -0,0 +1,73 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+nn = torch.nn
+F = torch.nn.functional
+
+
+class LabelSmoothingLoss(nn.Module):
+    " Reference: the smoothed KL divergence loss used before nn.CrossEntropyLoss(label_smoothing=...) "
+    def __init__(self, n_labels, smoothing=0.0, ignore_index=-100):
+        super(LabelSmoothingLoss, self).__init__()
+        self.ignore_index = ignore_index
+        self.confidence = 1 - smoothing
+
+        if smoothing > 0:
+            self.criterion = nn.KLDivLoss(reduction='mean')
+            n_ignore_idxs = 1 + (ignore_index >= 0)
+            one_hot = torch.full((1, n_labels), fill_value=(smoothing / (n_labels - n_ignore_idxs)))
+            if ignore_index >= 0:
+                one_hot[0, ignore_index] = 0
+            self.register_buffer('one_hot', one_hot)
+        else:
+            self.criterion = nn.NLLLoss(ignore_index=ignore_index)
+
+    def forward(self, log_inputs, targets):
+        if self.confidence < 1:
+            tmp = self.one_hot.repeat(targets.shape[0], 1)
+            tmp.scatter_(1, targets.unsqueeze(1), self.confidence)
+            if self.ignore_index >= 0:
+                tmp[targets.eq(self.ignore_index)] = 0
+            targets = tmp
+
+        return self.criterion(log_inputs, targets)
+
+
+N_LABELS, PADDING_IDX = 50, 0
+
+
+def _batch():
+    torch.manual_seed(0)
+    logits = torch.randn(32, N_LABELS, requires_grad=True)
+    targets = torch.randint(1, N_LABELS, (32,))
+    targets[-8:] = PADDING_IDX
+    return logits, targets
+
+
+def test_no_smoothing_matches_previous_loss():
+    logits, targets = _batch()
+
+    loss = nn.CrossEntropyLoss(ignore_index=PADDING_IDX, label_smoothing=0)(logits, targets)
+    expected = LabelSmoothingLoss(N_LABELS, 0, ignore_index=PADDING_IDX)(F.log_softmax(logits, dim=-1), targets)
+
+    assert torch.allclose(loss, expected)
+
+
+def test_smoothing_is_averaged_over_target_tokens():
+    logits, targets = _batch()
+    smoothing = 0.1
+
+    loss = nn.CrossEntropyLoss(ignore_index=PADDING_IDX, label_smoothing=smoothing)(logits, targets)
+    grad, = torch.autograd.grad(loss, logits)
+    previous_loss = LabelSmoothingLoss(N_LABELS, smoothing, ignore_index=PADDING_IDX)(F.log_softmax(logits, dim=-1), targets)
+    previous_grad, = torch.autograd.grad(previous_loss, logits)
+
+    # the smoothing mass is spread over all the classes, the loss is averaged over the non padding targets
+    keep = targets.ne(PADDING_IDX)
+    smoothed = F.one_hot(targets, N_LABELS).float() * (1 - smoothing) + smoothing / N_LABELS
+    expected = -(smoothed * F.log_softmax(logits, dim=-1)).sum(dim=-1)[keep].mean()
+    assert torch.allclose(loss, expected, atol=1e-6)
+
+    # the previous loss was averaged over every vocabulary element of every position (see README)
+    scale = len(targets) * N_LABELS / keep.sum().item()
+    assert torch.allclose(grad, previous_grad * scale, atol=1e-2 / len(targets))
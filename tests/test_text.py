@@ -0,0 +1,36 @@
+import copy
+import pickle
+
+import pytest
+
+pytest.importorskip('spacy')
+pytest.importorskip('ftfy')
+
+from model.text import BPEVocab
+
+
+def _vocab():
+    tokens = ['a</w>', 'b</w>', 'c</w>', 'a', 'b', 'c', 'ab</w>', 'abc</w>', 'ab']
+    codes = [('a', 'b</w>'), ('a', 'b'), ('ab', 'c</w>')]
+    return BPEVocab(tokens, codes, tokenizer=str.split, cache_size=4)
+
+
+@pytest.mark.parametrize('clone', [lambda v: pickle.loads(pickle.dumps(v)), copy.deepcopy])
+def test_vocab_with_merge_cache_can_be_cloned(clone):
+    vocab = _vocab()
+    ids = vocab.string2ids('ab abc ca')
+
+    cloned = clone(vocab)
+
+    assert cloned.string2ids('ab abc ca') == ids
+    assert cloned._bpe('abc') == vocab._bpe('abc') == ('abc</w>',)
+    assert cloned._bpe.cache_info().maxsize == 4
+
+
+def test_merge_cache_is_bounded_and_does_not_reference_the_vocab():
+    vocab = _vocab()
+    for word in ['a', 'b', 'c', 'ab', 'abc', 'ca']:
+        vocab._bpe(word)
+
+    assert vocab._bpe.cache_info().currsize == 4
+    assert vocab._bpe.__wrapped__.args == (vocab.bpe_ranks,)
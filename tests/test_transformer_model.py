@@ -0,0 +1,81 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('scipy')
+
+from model import transformer_model
+from model.transformer_model import TransformerModel
+
+
+def _small_model(**kwargs):
+    torch.manual_seed(0)
+    params = dict(n_layers=1, n_embeddings=16, n_pos_embeddings=32, embeddings_size=8,
+                  padding_idx=0, n_heads=2, dropout=0, embed_dropout=0, attn_dropout=0, ff_dropout=0,
+                  bos_id=1, eos_id=2, sent_dialog_id=3, max_seq_len=4, beam_size=2)
+    params.update(kwargs)
+    return TransformerModel(**params).eval()
+
+
+def test_predict_accepts_any_iterable_of_contexts():
+    model = _small_model()
+    contexts = [torch.randint(4, 16, (3, 5)), torch.randint(4, 16, (3, 7))]
+
+    torch.manual_seed(1)
+    from_list = model.predict(list(contexts))
+    torch.manual_seed(1)
+    from_map = model.predict(map(lambda c: c, contexts))
+
+    assert len(from_map) == 3
+    assert from_map == from_list
+
+
+@pytest.mark.parametrize('diversity_groups, diversity_coef', [(1, 0), (2, 0), (2, 0.5)])
+def test_beam_search_end_check_interval_does_not_change_results(monkeypatch, diversity_groups, diversity_coef):
+    model = _small_model(max_seq_len=20, beam_size=4, diversity_groups=diversity_groups, diversity_coef=diversity_coef)
+    torch.manual_seed(1)
+    contexts = [torch.randint(4, 16, (6, 5))]
+
+    def beam_search():
+        enc_contexts = model.encode_contexts(contexts)
+        beams, beam_lens = model.beam_search(enc_contexts, return_beams=True)
+        return beams, beam_lens, model.beam_search(enc_contexts)
+
+    monkeypatch.setattr(transformer_model, '_END_CHECK_STEPS', 1)
+    beams, beam_lens, predictions = beam_search()
+    monkeypatch.setattr(transformer_model, '_END_CHECK_STEPS', 8)
+    interval_beams, interval_beam_lens, interval_predictions = beam_search()
+
+    assert interval_predictions == predictions
+    assert torch.equal(interval_beam_lens, beam_lens)
+    # later checks only add padding columns
+    assert torch.equal(interval_beams[:, :, :beams.shape[-1]], beams)
+    assert (interval_beams[:, :, beams.shape[-1]:] == model.padding_idx).all()
+
+
+def test_encode_contexts_matches_separate_encodings():
+    model = _small_model()
+    torch.manual_seed(1)
+    contexts = [torch.randint(4, 16, (3, 5)), torch.randint(4, 16, (3, 9))]
+    contexts[0][1, 3:] = model.padding_idx  # right padded context
+
+    encoded = model.encode_contexts(contexts)
+
+    assert len(encoded) == len(contexts)
+    for context, (x, padding_mask) in zip(contexts, encoded):
+        expected_x, expected_padding_mask = model.encode(context)
+        assert torch.equal(padding_mask, expected_padding_mask)
+        keep = ~padding_mask.bool()
+        assert torch.allclose(x[keep], expected_x[keep], atol=1e-5)
+
+
+@pytest.mark.parametrize('diversity_groups, diversity_coef', [(1, 0), (2, 0.5)])
+def test_beam_search_batch_compaction_matches_single_items(diversity_groups, diversity_coef):
+    # a batch of one item is never compacted: it stops as soon as its beams are finished
+    model = _small_model(max_seq_len=20, beam_size=4, diversity_groups=diversity_groups, diversity_coef=diversity_coef)
+    torch.manual_seed(1)
+    context = torch.randint(4, 16, (8, 5))
+
+    predictions = model.predict([context])
+    single_predictions = [model.predict([context[i:i + 1]])[0] for i in range(len(context))]
+
+    assert predictions == single_predictions
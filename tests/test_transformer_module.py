@@ -0,0 +1,56 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+F = torch.nn.functional
+
+from model import transformer_module
+from model.transformer_module import MultiheadAttention
+from model.utils import repeat_along_dim1
+
+attention_impls = [False] + ([True] if hasattr(F, 'scaled_dot_product_attention') else [])
+
+
+def _attention():
+    torch.manual_seed(0)
+    return MultiheadAttention(n_features=8, n_heads=2, dropout=0).eval()
+
+
+def _padding_mask(batch_size, seq_len, lens):
+    return torch.arange(seq_len).unsqueeze(0) >= torch.tensor(lens).unsqueeze(1)
+
+
+@pytest.mark.parametrize('use_sdpa', attention_impls)
+def test_cross_attention_folded_queries_match_repeated_contexts(monkeypatch, use_sdpa):
+    monkeypatch.setattr(transformer_module, '_USE_SDPA', use_sdpa)
+    attention = _attention()
+    n_repeats = 3
+    context = torch.randn(2, 6, 8)
+    padding_mask = _padding_mask(2, 6, [6, 4])
+    query = torch.randn(2 * n_repeats, 5, 8)
+
+    folded, _, _ = attention(query, context, context, padding_mask)
+    repeated_context = repeat_along_dim1(context, n_repeats)
+    expected, _, _ = attention(query, repeated_context, repeated_context, repeat_along_dim1(padding_mask, n_repeats))
+
+    assert torch.allclose(folded, expected, atol=1e-6)
+
+
+@pytest.mark.skipif(len(attention_impls) < 2, reason='no scaled_dot_product_attention')
+@pytest.mark.parametrize('self_attention', [True, False])
+def test_sdpa_matches_explicit_attention(monkeypatch, self_attention):
+    attention = _attention()
+    x = torch.randn(3, 6, 8)
+    context = torch.randn(3, 7, 8)
+    # the last item has no key at all: its outputs are zeroed before the output projection
+    padding_mask = _padding_mask(3, 6 if self_attention else 7, [6, 2, 0])
+
+    outputs = []
+    for use_sdpa in attention_impls:
+        monkeypatch.setattr(transformer_module, '_USE_SDPA', use_sdpa)
+        if self_attention:
+            out, _, _ = attention(x, x, x, padding_mask)
+        else:
+            out, _, _ = attention(x, context, context, padding_mask)
+        outputs.append(out)
+
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-6)
@@ -105,6 +105,10 @@ def main():
                                    shared_attention=model_config.shared_attention,
                                    bs_temperature=model_config.bs_temperature,
                                    bs_nucleus_p=model_config.bs_nucleus_p,
+                                   bs_fp16=model_config.bs_fp16,
+                                   bs_low_precision=model_config.bs_low_precision,
+                                   compile_embeddings=model_config.compile_embeddings,
+                                   gradient_checkpointing=model_config.gradient_checkpointing,
                                    vocab=None)  # for beam search debugging
 
     if not trainer_config.load_last:
@@ -169,6 +173,7 @@ def main():
                             local_rank=args.local_rank,
                             apex_level=model_config.apex_level,
                             apex_loss_scale=trainer_config.apex_loss_scale,
+                            fp16=trainer_config.fp16,
                             linear_schedule=trainer_config.linear_schedule,
                             n_epochs=trainer_config.n_epochs,
                             evaluate_full_sequences=trainer_config.evaluate_full_sequences)
@@ -209,8 +214,9 @@ def main():
         samples_idxs = random.sample(range(len(test_dataset)), n_samples)
         samples = [test_dataset[idx] for idx in samples_idxs]
         for persona_info, dialog, target, _ in samples:
-            contexts = [torch.tensor([c], dtype=torch.long, device=model_trainer.device) for c in [persona_info, dialog] if len(c) > 0]
+            contexts = [c.unsqueeze(0).to(model_trainer.device) for c in [persona_info, dialog] if len(c) > 0]
             prediction = model_trainer.model.predict(contexts)[0]
+            persona_info, dialog, target = persona_info.tolist(), dialog.tolist(), target.tolist()
 
             persona_info_str = vocab.ids2string(persona_info[1:-1])
             dialog_str = vocab.ids2string(dialog)